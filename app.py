@@ -1,12 +1,19 @@
-from flask import Flask, request, jsonify, send_from_directory
-from flask_cors import CORS
+from flask import Flask, Response, request, jsonify, send_from_directory, abort
+from werkzeug.security import safe_join
 from flask_jwt_extended import JWTManager
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 import os
+import atexit
+import mimetypes
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from config.database import init_db
+from config.database import init_db, close_db, get_pool_stats
+from utils.json_provider import OrjsonProvider
+from middleware.auth import init_auth
 
 # Import blueprints
 from routes.advertisements import advertisements_bp
@@ -15,80 +22,76 @@ from routes.offers import offers_bp, init_limiter as init_offers_limiter
 from routes.analytics import analytics_bp, init_limiter as init_analytics_limiter
 from routes.ai_chat import ai_chat_bp, init_limiter as init_ai_chat_limiter
 
-# Load environment variables
-load_dotenv()
-
-app = Flask(__name__)
-
-# Configuration
-app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET', 'your-secret-key-change-in-production')
-app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(days=7)
-
-# Initialize extensions
-jwt = JWTManager(app)
-CORS(app, 
-     origins=['http://172.20.10.3:8080', 'http://localhost:8080', 'http://localhost:3000', '*'],  # Allow specific origins including IP
-     allow_headers=['Content-Type', 'Authorization', 'x-session-id'],
-     methods=['GET', 'POST', 'PUT', 'DELETE', 'OPTIONS'],
-     supports_credentials=False)  # Set to False when using origins='*'
-
-# Rate limiting
-limiter = Limiter(
-    key_func=get_remote_address,
-    app=app,
-    default_limits=["3000 per day", "400 per hour"]  # Increased for more users
-)
-
-# Initialize limiter for blueprints
-init_auth_limiter(limiter)
-init_offers_limiter(limiter)
-init_analytics_limiter(limiter)
-init_ai_chat_limiter(limiter)
-
-# Register blueprints
-app.register_blueprint(advertisements_bp, url_prefix='/api')
-app.register_blueprint(auth_bp, url_prefix='/api')
-app.register_blueprint(offers_bp, url_prefix='/api')
-app.register_blueprint(analytics_bp, url_prefix='/api')
-app.register_blueprint(ai_chat_bp, url_prefix='/api')
+logger = logging.getLogger(__name__)
+
+UPLOADS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
+
+# When set (e.g. /internal-uploads/), nginx serves upload bytes via X-Accel-Redirect
+UPLOADS_ACCEL_PREFIX = os.getenv('UPLOADS_ACCEL_PREFIX')
+
+# CORS - every origin is allowed and credentials are not used, so the headers never vary
+CORS_ALLOW_HEADERS = 'Content-Type, Authorization, x-session-id'
+CORS_ALLOW_METHODS = 'GET, POST, PUT, DELETE, OPTIONS'
+CORS_MAX_AGE = '86400'
+# Set when Nginx adds the CORS headers so the app doesn't duplicate them
+CORS_AT_PROXY = os.getenv('CORS_AT_PROXY', 'false').lower() == 'true'
+
+def configure_logging():
+    """Configure root logging so records are written by a background thread"""
+    root = logging.getLogger()
+    if root.handlers:
+        return
+    
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    listener = QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
 
 # Static file serving for uploads
-@app.route('/uploads/<path:filename>')
 def uploaded_file(filename):
     """Serve uploaded files"""
-    uploads_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
-    return send_from_directory(uploads_dir, filename)
+    if UPLOADS_ACCEL_PREFIX:
+        # Hand the transfer to nginx (sendfile) instead of streaming it through the worker
+        path = safe_join(UPLOADS_ACCEL_PREFIX, filename)
+        if path is None:
+            abort(404)
+        # nginx keeps the Content-Type set here, so it must match the file
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        return Response(mimetype=mimetype, headers={'X-Accel-Redirect': path})
+    return send_from_directory(UPLOADS_DIR, filename)
 
 # Add request logging for debugging
-@app.before_request
 def log_request_info():
-    print(f"🔍 {request.method} {request.url}")
+    """Log incoming requests; skipped entirely unless DEBUG logging is enabled"""
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    logger.debug("🔍 %s %s", request.method, request.url)
     # Only log essential info, not full headers
-    if request.headers.get('Origin'):
-        print(f"🌐 Origin: {request.headers.get('Origin')}")
-    if request.method == 'POST' and request.headers.get('Content-Type') == 'application/json':
-        try:
-            json_data = request.get_json()
-            if json_data:
-                # Only log non-sensitive data
-                safe_data = {k: v for k, v in json_data.items() if k not in ['password', 'confirmPassword', 'token']}
-                print(f"📋 JSON Data: {safe_data}")
-        except Exception as json_error:
-            print(f"❌ JSON parsing error: {json_error}")
-    print("---")
-
-# Initialize database
-init_db()
-
-# Update database schema for password reset functionality
-try:
-    from models.user import User
-    User.update_database_schema()
-except Exception as e:
-    print(f"⚠️ Warning: Could not update database schema: {e}")
+    origin = request.headers.get('Origin')
+    if origin:
+        logger.debug("🌐 Origin: %s", origin)
+    if request.method == 'POST' and request.is_json:
+        json_data = request.get_json(silent=True)
+        if isinstance(json_data, dict):
+            # Only log non-sensitive data
+            safe_data = {k: v for k, v in json_data.items() if k not in ['password', 'confirmPassword', 'token']}
+            logger.debug("📋 JSON Data: %s", safe_data)
+
+def add_cors_headers(response):
+    """Add CORS headers to every response (Flask answers OPTIONS automatically)"""
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    if request.method == 'OPTIONS':
+        response.headers['Access-Control-Allow-Headers'] = CORS_ALLOW_HEADERS
+        response.headers['Access-Control-Allow-Methods'] = CORS_ALLOW_METHODS
+        response.headers['Access-Control-Max-Age'] = CORS_MAX_AGE
+    return response
 
 # Error handlers
-@app.errorhandler(400)
 def bad_request(error):
     return jsonify({
         'success': False,
@@ -96,7 +99,6 @@ def bad_request(error):
         'errors': [str(error)]
     }), 400
 
-@app.errorhandler(401)
 def unauthorized(error):
     return jsonify({
         'success': False,
@@ -104,7 +106,6 @@ def unauthorized(error):
         'errors': [str(error)]
     }), 401
 
-@app.errorhandler(404)
 def not_found(error):
     return jsonify({
         'success': False,
@@ -112,7 +113,6 @@ def not_found(error):
         'errors': [str(error)]
     }), 404
 
-@app.errorhandler(500)
 def internal_error(error):
     return jsonify({
         'success': False,
@@ -120,7 +120,6 @@ def internal_error(error):
         'errors': [str(error)]
     }), 500
 
-@app.errorhandler(422)
 def unprocessable_entity(error):
     print(f"🚨 422 Error occurred: {error}")
     return jsonify({
@@ -129,21 +128,110 @@ def unprocessable_entity(error):
         'errors': [str(error)]
     }), 422
 
-# Health check endpoint
-@app.route('/health', methods=['GET'])
+# Health check endpoint - static body, only the timestamp changes
+HEALTH_RESPONSE_TEMPLATE = '{{"message":"Server is running","success":true,"timestamp":"{}"}}'
+
 def health_check():
+    return Response(HEALTH_RESPONSE_TEMPLATE.format(datetime.now().isoformat()), mimetype='application/json')
+
+def database_health_check():
     return jsonify({
         'success': True,
-        'message': 'Server is running',
-        'timestamp': datetime.now().isoformat()
+        'pool': get_pool_stats()
     })
 
+def create_app():
+    """Create and configure the Flask application (WSGI entrypoint for gunicorn)"""
+    # Load environment variables
+    load_dotenv()
+    configure_logging()
+
+    app = Flask(__name__)
+    app.json = OrjsonProvider(app)
+
+    # Configuration
+    app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET', 'your-secret-key-change-in-production')
+    app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(days=7)
+    app.config['JWT_ALGORITHM'] = 'HS256'
+    app.config['JWT_DECODE_ALGORITHMS'] = ['HS256']
+
+    # Initialize extensions
+    JWTManager(app)
+    init_auth(app)
+
+    # Rate limiting - shared Redis storage keeps limits consistent across gunicorn workers
+    # (e.g. RATELIMIT_STORAGE_URI=redis://localhost:6379/0); falls back to per-process memory
+    limiter = Limiter(
+        key_func=get_remote_address,
+        app=app,
+        default_limits=["3000 per day", "400 per hour"],  # Increased for more users
+        storage_uri=os.getenv('RATELIMIT_STORAGE_URI', 'memory://'),
+        strategy='moving-window'
+    )
+
+    # Initialize limiter for blueprints
+    init_auth_limiter(limiter)
+    init_offers_limiter(limiter)
+    init_analytics_limiter(limiter)
+    init_ai_chat_limiter(limiter)
+
+    # Register blueprints
+    app.register_blueprint(advertisements_bp, url_prefix='/api')
+    app.register_blueprint(auth_bp, url_prefix='/api')
+    app.register_blueprint(offers_bp, url_prefix='/api')
+    app.register_blueprint(analytics_bp, url_prefix='/api')
+    app.register_blueprint(ai_chat_bp, url_prefix='/api')
+
+    app.add_url_rule('/uploads/<path:filename>', view_func=uploaded_file)
+    app.add_url_rule('/health', view_func=health_check, methods=['GET'])
+    app.add_url_rule('/health/db', view_func=database_health_check, methods=['GET'])
+    app.before_request(log_request_info)
+    if not CORS_AT_PROXY:
+        app.after_request(add_cors_headers)
+
+    app.register_error_handler(400, bad_request)
+    app.register_error_handler(401, unauthorized)
+    app.register_error_handler(404, not_found)
+    app.register_error_handler(500, internal_error)
+    app.register_error_handler(422, unprocessable_entity)
+
+    # Initialize database
+    init_db()
+    # Registered before the lazily started tracking writers, so their atexit flushes run first
+    atexit.register(close_db)
+
+    # Update database schema for password reset functionality
+    try:
+        from models.user import User
+        User.update_database_schema()
+    except Exception as e:
+        print(f"⚠️ Warning: Could not update database schema: {e}")
+
+    # Index builds and the newer schema changes run once per deploy from migrate.py,
+    # not in every worker; partition upkeep is cheap and idempotent, so it stays here
+    from models.analytics import Analytics
+    Analytics.ensure_event_partitions()
+
+    from models.ai_chat import AIChat
+    AIChat.preload_credentials()
+
+    return app
+
+app = create_app()
+
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 5002))  # Changed from 5001 to 5002
+    environment = os.getenv('NODE_ENV', 'development')
     debug = os.getenv('FLASK_ENV') == 'development' or os.getenv('NODE_ENV') == 'development'
-    
+
+    if environment != 'development' and os.getenv('FLASK_ENV') != 'development':
+        # The Werkzeug server is single-threaded and not meant for production traffic
+        print("⚠️ Refusing to start the development server outside development")
+        print(f"👉 Run: gunicorn app:app -k gthread --bind 0.0.0.0:{port} --workers 4 --threads 16")
+        raise SystemExit(1)
+
     print(f"🚀 Server starting on port {port}")
-    print(f"📊 Environment: {os.getenv('NODE_ENV', 'development')}")
+    print(f"📊 Environment: {environment}")
     print(f"🔗 Database: {os.getenv('DB_NAME', 'etuhinta')}")
-    
-    app.run(host='0.0.0.0', port=port, debug=debug) 
\ No newline at end of file
+
+    app.run(host='0.0.0.0', port=port, debug=debug)
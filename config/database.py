@@ -2,6 +2,8 @@ import psycopg2
 import psycopg2.extras
 import psycopg2.pool
 import os
+import re
+import time
 from contextlib import contextmanager
 from dotenv import load_dotenv
 
@@ -15,22 +17,77 @@ DB_CONFIG = {
     'database': os.getenv('DB_NAME', 'etuhinta'),
     'user': os.getenv('DB_USER', 'fowsi'),
     'password': os.getenv('DB_PASSWORD', 'AnwaR.88'),
+    # TCP keepalives stop idle pooled connections from being dropped by NAT/firewalls
+    'keepalives': 1,
+    'keepalives_idle': 30,
+    'keepalives_interval': 10,
+    'keepalives_count': 5,
 }
 
-# Connection pool
+# Pool sizing - when DB_HOST points at pgbouncer (transaction pooling),
+# set DB_POOL_MAX to match pgbouncer's default_pool_size
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 4))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 20))
+
+# Connections idle for longer than this are checked with SELECT 1 before reuse
+DB_POOL_IDLE_CHECK_SECONDS = 30
+
+# Analytics writes are fire-and-forget, so they use a separate small pool whose
+# sessions run with synchronous_commit=off: commits don't wait for the WAL flush,
+# and a crash can lose at most the last ~3x wal_writer_delay of analytics events
+DB_ANALYTICS_POOL_MAX = int(os.getenv('DB_ANALYTICS_POOL_MAX', 4))
+
+# Server-side prepared statements for hot queries - disable when DB_HOST is
+# pgbouncer in transaction pooling mode (SQL-level PREPARE is per session)
+DB_PREPARED_STATEMENTS = os.getenv('DB_PREPARED_STATEMENTS', 'true').lower() == 'true'
+
+# Connection pools
 connection_pool = None
+analytics_connection_pool = None
+
+class PreparedStatementConnection(psycopg2.extensions.connection):
+    """Connection that remembers which statements have been PREPAREd on it"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = set()
+        self.last_used = time.monotonic()
+
+def patch_for_gevent():
+    """Make psycopg2 cooperative when running under gunicorn's gevent worker"""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return
+    
+    if monkey.is_module_patched('socket'):
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+        print("✅ psycopg2 patched for gevent")
 
 def init_db():
     """Initialize database connection pool"""
-    global connection_pool
+    global connection_pool, analytics_connection_pool
     
     try:
+        patch_for_gevent()
+        
+        # ThreadedConnectionPool opens minconn connections up front, so the pool starts warm
         connection_pool = psycopg2.pool.ThreadedConnectionPool(
+            minconn=DB_POOL_MIN,
+            maxconn=DB_POOL_MAX,
+            connection_factory=PreparedStatementConnection,
+            **DB_CONFIG
+        )
+        print(f"✅ Database connection pool created successfully ({DB_POOL_MIN}-{DB_POOL_MAX} connections)")
+        
+        analytics_connection_pool = psycopg2.pool.ThreadedConnectionPool(
             minconn=1,
-            maxconn=20,
+            maxconn=DB_ANALYTICS_POOL_MAX,
+            connection_factory=PreparedStatementConnection,
+            options='-c synchronous_commit=off',
             **DB_CONFIG
         )
-        print("✅ Database connection pool created successfully")
         
         # Test connection
         with get_db_connection() as conn:
@@ -43,23 +100,133 @@ def init_db():
         print(f"❌ Error creating connection pool: {error}")
         raise error
 
+def _is_usable(connection):
+    """Check a pooled connection before handing it out"""
+    if connection.closed:
+        return False
+    if time.monotonic() - connection.last_used < DB_POOL_IDLE_CHECK_SECONDS:
+        return True
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        connection.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def _checkout_connection(pool):
+    """Get a live connection from the pool, discarding dead ones"""
+    # Every pooled connection could be dead (e.g. after a server restart)
+    for _ in range(pool.maxconn + 1):
+        connection = pool.getconn()
+        if _is_usable(connection):
+            return connection
+        pool.putconn(connection, close=True)
+    raise psycopg2.OperationalError("No usable database connection available")
+
 @contextmanager
-def get_db_connection():
-    """Get database connection from pool with context manager"""
+def get_db_connection(autocommit=False):
+    """Get database connection from pool with context manager
+    
+    Use autocommit=True for read-only work: it skips the implicit BEGIN and
+    the rollback the pool would otherwise issue when the connection is returned.
+    """
     if connection_pool is None:
         raise Exception("Database connection pool not initialized")
     
+    with _pooled_connection(connection_pool, autocommit) as connection:
+        yield connection
+
+@contextmanager
+def get_analytics_db_connection():
+    """Get a connection for analytics writes (synchronous_commit=off)"""
+    if analytics_connection_pool is None:
+        raise Exception("Database connection pool not initialized")
+    
+    with _pooled_connection(analytics_connection_pool) as connection:
+        yield connection
+
+@contextmanager
+def _pooled_connection(pool, autocommit=False):
+    """Check a connection out of pool and return (or discard) it afterwards"""
     connection = None
+    discard = False
     try:
-        connection = connection_pool.getconn()
+        connection = _checkout_connection(pool)
+        if autocommit:
+            connection.autocommit = True
         yield connection
     except Exception as error:
         if connection:
-            connection.rollback()
+            # Broken connections are closed instead of going back to the pool
+            discard = isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError))
+            if not connection.closed:
+                try:
+                    connection.rollback()
+                except psycopg2.Error:
+                    discard = True
         raise error
     finally:
         if connection:
-            connection_pool.putconn(connection)
+            connection.last_used = time.monotonic()
+            if autocommit and not connection.closed:
+                connection.autocommit = False
+            pool.putconn(connection, close=discard or bool(connection.closed))
+
+def get_pool_stats():
+    """Return connection pool usage for monitoring"""
+    if connection_pool is None:
+        return {'initialized': False}
+    
+    in_use = len(connection_pool._used)
+    return {
+        'initialized': True,
+        'inUse': in_use,
+        'idle': len(connection_pool._pool),
+        'max': connection_pool.maxconn,
+        'saturation': round(in_use / connection_pool.maxconn, 2)
+    }
+
+_PLACEHOLDER_RE = re.compile(r'%%|%s')
+
+def execute_prepared(cursor, name, query, params=()):
+    """Execute query as a named prepared statement on the cursor's connection
+    
+    The query uses %s placeholders like any other psycopg2 query; it is
+    PREPAREd once per pooled connection and then run with EXECUTE.
+    """
+    if not DB_PREPARED_STATEMENTS:
+        cursor.execute(query, params)
+        return
+    
+    conn = cursor.connection
+    if name not in conn.prepared_statements:
+        # %s -> $1..$n; %% -> % since the PREPARE text is sent without parameter formatting
+        counter = iter(range(1, len(params) + 1))
+        statement = _PLACEHOLDER_RE.sub(lambda m: '%' if m.group() == '%%' else f'${next(counter)}', query)
+        cursor.execute(f"PREPARE {name} AS {statement}")
+        conn.prepared_statements.add(name)
+    
+    if params:
+        cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+    else:
+        cursor.execute(f"EXECUTE {name}")
+
+def create_index_concurrently(cursor, name, statement):
+    """Run a CREATE INDEX CONCURRENTLY IF NOT EXISTS statement for index name
+    
+    A failed concurrent build leaves an INVALID index behind, which IF NOT EXISTS
+    would then skip forever, so an invalid one is dropped and built again.
+    The cursor must belong to an autocommit connection.
+    """
+    cursor.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", (name,))
+    row = cursor.fetchone()
+    if row and row[0]:
+        return
+    if row:
+        print(f"⚠️ Rebuilding invalid index {name}")
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    cursor.execute(statement)
 
 def execute_query(query, params=None, fetch_one=False, fetch_all=False):
     """Execute a database query"""
@@ -82,9 +249,11 @@ def execute_query_dict(query, params=None, fetch_one=False, fetch_all=False):
             cursor.execute(query, params)
             
             if fetch_one:
-                return dict(cursor.fetchone()) if cursor.fetchone() else None
+                row = cursor.fetchone()
+                return dict(row) if row is not None else None
             elif fetch_all:
-                return [dict(row) for row in cursor.fetchall()]
+                # RealDictRow is already a dict subclass, no need to copy each row
+                return cursor.fetchall()
             else:
                 conn.commit()
                 return cursor.rowcount
@@ -92,6 +261,8 @@ def execute_query_dict(query, params=None, fetch_one=False, fetch_all=False):
 def close_db():
     """Close database connection pool"""
     global connection_pool
+    if analytics_connection_pool:
+        analytics_connection_pool.closeall()
     if connection_pool:
         connection_pool.closeall()
         print("🔒 Database connection pool closed") 
\ No newline at end of file
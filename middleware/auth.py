@@ -1,51 +1,73 @@
+import logging
 from functools import wraps
-from flask import request, jsonify
-from flask_jwt_extended import jwt_required, get_jwt_identity
+from flask import request, jsonify, g
+from flask_jwt_extended import verify_jwt_in_request, get_jwt_identity
+from flask_jwt_extended.exceptions import JWTExtendedException, NoAuthorizationError
+from jwt import PyJWTError
 from models.user import User
 
+logger = logging.getLogger(__name__)
+
+def load_jwt_identity():
+    """Decode the JWT once per request and store the user ID on g (None if absent/invalid)
+    
+    Authentication is optional here, so public routes still work with a stale
+    token; the decode error is kept on g for require_auth/require_admin.
+    """
+    g.user_id = None
+    g.jwt_error = None
+    if 'Authorization' not in request.headers:
+        return
+    try:
+        verify_jwt_in_request(optional=True)
+        identity = get_jwt_identity()
+        if identity:
+            g.user_id = int(identity)
+    except (JWTExtendedException, PyJWTError) as e:
+        g.jwt_error = e
+        logger.debug("Invalid JWT on %s: %s", request.path, e)
+    except Exception as e:
+        logger.debug("Invalid JWT on %s: %s", request.path, e)
+
+def _raise_jwt_error():
+    """Re-raise the request's JWT error so flask_jwt_extended's handlers answer as @jwt_required() did"""
+    error = g.get('jwt_error')
+    if error is not None:
+        raise error
+    raise NoAuthorizationError('Missing Authorization Header')
+
+def init_auth(app):
+    """Register the shared JWT parsing hook on the app"""
+    app.before_request(load_jwt_identity)
+
 def require_auth(f):
     """Decorator to require authentication for a route"""
     @wraps(f)
-    @jwt_required()
     def decorated_function(*args, **kwargs):
-        try:
-            # Get user ID from JWT token
-            user_id = get_jwt_identity()
-            if not user_id:
-                return jsonify({
-                    'success': False,
-                    'message': 'Authentication required'
-                }), 401
-            
-            # Add user_id to request for use in the route
-            request.user_id = int(user_id)
-            
-            return f(*args, **kwargs)
-        except Exception as e:
-            print(f"❌ Auth middleware error: {e}")
-            return jsonify({
-                'success': False,
-                'message': 'Authentication failed'
-            }), 401
+        # User ID was decoded from the JWT by load_jwt_identity
+        user_id = g.get('user_id')
+        if not user_id:
+            _raise_jwt_error()
+        
+        # Add user_id to request for use in the route
+        request.user_id = user_id
+        
+        return f(*args, **kwargs)
     
     return decorated_function
 
 def require_admin(f):
     """Decorator to require admin authentication for a route"""
     @wraps(f)
-    @jwt_required()
     def decorated_function(*args, **kwargs):
+        # User ID was decoded from the JWT by load_jwt_identity
+        user_id = g.get('user_id')
+        if not user_id:
+            _raise_jwt_error()
+        
         try:
-            # Get user ID from JWT token
-            user_id = get_jwt_identity()
-            if not user_id:
-                return jsonify({
-                    'success': False,
-                    'message': 'Authentication required'
-                }), 401
-            
             # Check if user exists and is admin
-            user = User.find_by_id(int(user_id))
+            user = User.find_by_id(user_id)
             if not user:
                 return jsonify({
                     'success': False,
@@ -60,17 +82,17 @@ def require_admin(f):
                     'success': False,
                     'message': 'Admin access required'
                 }), 403
-            
-            # Add user_id to request for use in the route
-            request.user_id = int(user_id)
-            request.user = user
-            
-            return f(*args, **kwargs)
         except Exception as e:
             print(f"❌ Admin auth middleware error: {e}")
             return jsonify({
                 'success': False,
                 'message': 'Authentication failed'
             }), 401
+        
+        # Add user_id to request for use in the route
+        request.user_id = user_id
+        request.user = user
+        
+        return f(*args, **kwargs)
     
     return decorated_function 
\ No newline at end of file
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""Apply schema changes and build indexes, once per deploy
+
+    python migrate.py
+
+The nixpacks start command runs this before gunicorn. Index builds use
+CREATE INDEX CONCURRENTLY, which must not run from every worker at boot:
+the workers would race each other, and a failed build leaves an INVALID index.
+"""
+
+import sys
+from config.database import init_db, close_db, get_db_connection
+
+def migrate():
+    """Run every migration step in order, stopping at the first failure"""
+    from models.advertisement import Advertisement
+    from models.tarjous import Tarjous
+    from models.analytics import Analytics
+    from models.offer_analytics import OfferAnalytics
+    
+    steps = [
+        Analytics.update_database_schema,
+        Analytics.create_indexes,
+        Advertisement.create_indexes,
+        Tarjous.create_search_indexes,
+        OfferAnalytics.create_indexes,
+        OfferAnalytics.update_database_schema,
+    ]
+    
+    with get_db_connection(autocommit=True) as conn:
+        with conn.cursor() as cursor:
+            # Only one migration runs at a time, e.g. when several instances deploy together
+            cursor.execute("SELECT pg_advisory_lock(hashtext('etuh_migrate'))")
+            try:
+                for step in steps:
+                    step()
+            finally:
+                cursor.execute("SELECT pg_advisory_unlock(hashtext('etuh_migrate'))")
+
+if __name__ == '__main__':
+    init_db()
+    try:
+        migrate()
+        print('✅ Migrations complete')
+    except Exception as error:
+        print(f'❌ Migration failed: {error}')
+        sys.exit(1)
+    finally:
+        close_db()
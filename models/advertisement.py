@@ -1,8 +1,46 @@
 from datetime import datetime
-from config.database import get_db_connection
+from collections import Counter
+from itertools import groupby
+import atexit
+import random
+import threading
+import time
+from config.database import get_db_connection, execute_prepared, create_index_concurrently
+from utils.cache import TTLCache
 import psycopg2.extras
 
+# Active ads change rarely - cache the full active set for a minute
+_active_ads_cache = TTLCache(maxsize=1, ttl=60)
+
+# Table-wide aggregates for the stats endpoint, recomputed at most every 30s
+_stats_cache = TTLCache(maxsize=1, ttl=30)
+
+# Clicks on known-active ads are counted in memory and flushed in batches
+CLICK_FLUSH_INTERVAL = 1.0
+_pending_clicks = Counter()
+_clicks_lock = threading.Lock()
+_click_flusher = None
+
 class Advertisement:
+    # (row column, API key) pairs used to build API dicts straight from query rows
+    _FIELD_MAP = (
+        ('id', 'id'),
+        ('title', 'title'),
+        ('subtitle', 'subtitle'),
+        ('icon', 'icon'),
+        ('icon_type', 'iconType'),
+        ('icon_url', 'iconUrl'),
+        ('icon_s3_key', 'iconS3Key'),
+        ('background_gradient', 'backgroundGradient'),
+        ('background_gradient', 'background'),  # Alias for compatibility
+        ('cta_text', 'ctaText'),
+        ('cta_text', 'cta'),  # Alias for compatibility
+        ('cta_url', 'ctaUrl'),
+        ('category', 'category'),
+        ('display_priority', 'displayPriority'),
+        ('clicks', 'clicks'),
+    )
+
     def __init__(self, ad_data):
         self.id = ad_data.get('id')
         self.title = ad_data.get('title')
@@ -20,6 +58,9 @@ class Advertisement:
         self.clicks = ad_data.get('clicks', 0)
         self.created_at = ad_data.get('created_at')
         self.expiration_date = ad_data.get('expiration_date')
+        # Serialize timestamps once instead of on every to_dict() call
+        self.created_at_iso = self.created_at.isoformat() if self.created_at else None
+        self.expiration_date_iso = self.expiration_date.isoformat() if self.expiration_date else None
 
     def to_dict(self):
         """Convert advertisement object to dictionary for API response"""
@@ -40,45 +81,90 @@ class Advertisement:
             'isActive': self.is_active,
             'displayPriority': self.display_priority,
             'clicks': self.clicks,
-            'createdAt': self.created_at.isoformat() if self.created_at else None,
-            'expirationDate': self.expiration_date.isoformat() if self.expiration_date else None
+            'createdAt': self.created_at_iso,
+            'expirationDate': self.expiration_date_iso
         }
 
+    @staticmethod
+    def _row_to_api_dict(row):
+        """Build the API dict for an active advertisement row without creating an object"""
+        ad = {dst: row[src] for src, dst in Advertisement._FIELD_MAP}
+        ad['isActive'] = True
+        ad['createdAt'] = row['created_at'].isoformat() if row['created_at'] else None
+        ad['expirationDate'] = row['expiration_date'].isoformat() if row['expiration_date'] else None
+        return ad
+
+    @staticmethod
+    def _load_active_ads():
+        """Load all active advertisements grouped by display priority (highest first)
+        
+        Returns a (groups, ids) tuple where ids is the set of active ad IDs.
+        """
+        cached = _active_ads_cache.get('active')
+        if cached is not None:
+            return cached
+        
+        with get_db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                execute_prepared(cursor, 'ads_active', """
+                    SELECT id, title, subtitle, icon, icon_type, icon_url, icon_s3_key,
+                           background_gradient, cta_text, cta_url, category, 
+                           display_priority, clicks, created_at, expiration_date
+                    FROM advertisements 
+                    WHERE is_active = true
+                    AND (expiration_date IS NULL OR expiration_date > CURRENT_DATE)
+                    ORDER BY display_priority DESC
+                """)
+                results = cursor.fetchall()
+        
+        groups = [
+            [Advertisement._row_to_api_dict(row) for row in rows]
+            for _, rows in groupby(results, key=lambda row: row['display_priority'])
+        ]
+        ids = frozenset(row['id'] for row in results)
+        _active_ads_cache.set('active', (groups, ids))
+        return groups, ids
+
     @staticmethod
     def get_active_ads(limit=10):
         """Get active advertisements for display - only returns ads where is_active = true"""
         try:
-            with get_db_connection() as conn:
-                with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
-                    # Updated query to include icon fields
-                    cursor.execute("""
-                        SELECT id, title, subtitle, icon, icon_type, icon_url, icon_s3_key,
-                               background_gradient, cta_text, cta_url, category, 
-                               display_priority, clicks, created_at, expiration_date
-                        FROM advertisements 
-                        WHERE is_active = true
-                        AND (expiration_date IS NULL OR expiration_date > CURRENT_DATE)
-                        ORDER BY display_priority DESC, RANDOM()
-                        LIMIT %s
-                    """, (limit,))
-                    results = cursor.fetchall()
-            
-            # Convert to Advertisement objects and return as dictionaries
-            ads = [Advertisement(dict(row)).to_dict() for row in results]
+            # Highest priority first, random order within the same priority
+            ads = []
+            groups, _ = Advertisement._load_active_ads()
+            for group in groups:
+                remaining = limit - len(ads)
+                if remaining <= 0:
+                    break
+                ads.extend(random.sample(group, min(len(group), remaining)))
             return ads
             
         except Exception as error:
             print(f'❌ Error getting active advertisements: {error}')
             return []
 
+    @staticmethod
+    def clear_cache():
+        """Invalidate cached active advertisements and stats (call after admin changes)"""
+        _active_ads_cache.clear()
+        _stats_cache.clear()
+
     @staticmethod
     def track_click(ad_id):
         """Track a click for an advertisement - only for active ads"""
         try:
+            _, active_ids = Advertisement._load_active_ads()
+            if ad_id in active_ids:
+                # Known-active ad: count in memory, the background flusher writes it
+                with _clicks_lock:
+                    _pending_clicks[ad_id] += 1
+                Advertisement._start_click_flusher()
+                return True
+            
             with get_db_connection() as conn:
                 with conn.cursor() as cursor:
                     # Only track clicks for active advertisements
-                    cursor.execute("""
+                    execute_prepared(cursor, 'ads_track_click', """
                         UPDATE advertisements 
                         SET clicks = clicks + 1
                         WHERE id = %s AND is_active = true
@@ -94,6 +180,45 @@ class Advertisement:
             print(f'❌ Error tracking click for ad {ad_id}: {error}')
             return False
 
+    @staticmethod
+    def flush_clicks():
+        """Write pending click counts to the database in a single UPDATE"""
+        with _clicks_lock:
+            if not _pending_clicks:
+                return
+            pending = list(_pending_clicks.items())
+            _pending_clicks.clear()
+        
+        try:
+            with get_db_connection() as conn:
+                with conn.cursor() as cursor:
+                    psycopg2.extras.execute_values(cursor, """
+                        UPDATE advertisements AS a
+                        SET clicks = a.clicks + v.delta
+                        FROM (VALUES %s) AS v(id, delta)
+                        WHERE a.id = v.id AND a.is_active = true
+                    """, pending)
+                    conn.commit()
+        except Exception as error:
+            print(f'❌ Error flushing advertisement clicks: {error}')
+            # Keep the counts for the next flush
+            with _clicks_lock:
+                _pending_clicks.update(dict(pending))
+
+    @staticmethod
+    def _start_click_flusher():
+        """Start the background click flusher once per process"""
+        global _click_flusher
+        if _click_flusher is not None:
+            return
+        
+        with _clicks_lock:
+            if _click_flusher is not None:
+                return
+            _click_flusher = threading.Thread(target=_run_click_flusher, name="ad-click-flusher", daemon=True)
+            _click_flusher.start()
+        atexit.register(Advertisement.flush_clicks)
+
     @staticmethod
     def find_by_id(ad_id):
         """Find advertisement by ID"""
@@ -102,38 +227,66 @@ class Advertisement:
             
             with get_db_connection() as conn:
                 with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
-                    cursor.execute(query, (ad_id,))
+                    execute_prepared(cursor, 'ads_find_by_id', query, (ad_id,))
                     result = cursor.fetchone()
             
             if not result:
                 return None
             
-            return Advertisement(dict(result))
+            return Advertisement(result)
             
         except Exception as error:
             print(f'❌ Error finding advertisement by ID: {error}')
             raise error
 
+    @staticmethod
+    def create_indexes():
+        """Create the partial index used to load the active advertisement set"""
+        try:
+            # CURRENT_DATE is not immutable, so the expiration check stays in the query
+            query = """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS ads_active_priority_idx
+            ON advertisements (display_priority DESC)
+            WHERE is_active = true;
+            """
+            
+            # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+            with get_db_connection(autocommit=True) as conn:
+                with conn.cursor() as cursor:
+                    create_index_concurrently(cursor, 'ads_active_priority_idx', query)
+            
+            print('✅ Advertisement indexes ready')
+            
+        except Exception as error:
+            print(f'❌ Error creating advertisement indexes: {error}')
+            raise error
+
     @staticmethod
     def get_stats():
-        """Get simple advertisement statistics"""
+        """Get simple advertisement statistics (cached for 30 seconds)"""
+        stats = _stats_cache.get('stats')
+        if stats is not None:
+            return stats
+        
         try:
             with get_db_connection() as conn:
                 with conn.cursor() as cursor:
-                    cursor.execute("""
+                    execute_prepared(cursor, 'ads_stats', """
                         SELECT 
                             COUNT(*) as total_ads,
                             COUNT(*) FILTER (WHERE is_active = true) as active_ads,
                             SUM(clicks) as total_clicks
                         FROM advertisements
                     """)
-                    stats = cursor.fetchone()
-                    
-                    return {
-                        'totalAds': stats[0] or 0,
-                        'activeAds': stats[1] or 0,
-                        'totalClicks': stats[2] or 0
-                    }
+                    row = cursor.fetchone()
+            
+            stats = {
+                'totalAds': row[0] or 0,
+                'activeAds': row[1] or 0,
+                'totalClicks': row[2] or 0
+            }
+            _stats_cache.set('stats', stats)
+            return stats
             
         except Exception as error:
             print(f'❌ Error getting advertisement stats: {error}')
@@ -141,4 +294,10 @@ class Advertisement:
                 'totalAds': 0,
                 'activeAds': 0,
                 'totalClicks': 0
-            } 
\ No newline at end of file
+            }
+
+def _run_click_flusher():
+    """Background loop flushing batched advertisement clicks"""
+    while True:
+        time.sleep(CLICK_FLUSH_INTERVAL)
+        Advertisement.flush_clicks()
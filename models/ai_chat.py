@@ -1,56 +1,338 @@
-import json
+import logging
+import os
+import threading
+import time
+import httpx
 import openai
-import psycopg2.extras
+import orjson
 from typing import List, Dict, Any, Optional
-from datetime import datetime
-from config.database import get_db_connection
-from models.tarjous import Tarjous
+from config.database import get_db_connection, execute_prepared
+from utils.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+# OpenAI credentials rarely change - share them across requests
+CRED_TTL_SECONDS = 300
+DEFAULT_CHAT_LIMIT = 15
+
+# A chat request holds a worker thread for the whole OpenAI call - bound how long that can be
+OPENAI_TIMEOUT_SECONDS = float(os.getenv('OPENAI_TIMEOUT_SECONDS', 20))
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', 1))
+
+# One keep-alive HTTP pool to api.openai.com per process, reused across key rotations
+_openai_http_client = httpx.Client(
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    timeout=httpx.Timeout(OPENAI_TIMEOUT_SECONDS, connect=5.0)
+)
+_credential_cache = {'value': None, 'ts': 0.0, 'loaded': False, 'refreshing': False}
+_credential_lock = threading.Lock()
+
+# Identical chat searches ("pizza Helsinki") within a minute reuse the same result
+_offer_search_cache = TTLCache(maxsize=1024, ttl=60)
+
+
+def _fetch_api_credentials():
+    """Load OpenAI credentials from database into the shared cache
+    
+    Returns an (api_key, model_name, chat_limit) tuple, or None. A missing row or a
+    failed query is cached as well, so it is retried only after CRED_TTL_SECONDS.
+    """
+    try:
+        with get_db_connection(autocommit=True) as conn:
+            with conn.cursor() as cursor:
+                # Get OpenAI credentials including chat_limit
+                cursor.execute("""
+                    SELECT api_key, model_name, chat_limit 
+                    FROM ai_model_credentials 
+                    WHERE service_name = 'OpenAI' 
+                    ORDER BY created_at DESC 
+                    LIMIT 1
+                """)
+                
+                result = cursor.fetchone()
+        
+        if not result:
+            print("❌ No OpenAI credentials found in database")
+            value = None
+        else:
+            value = (result[0], result[1] or 'gpt-4o', result[2] or DEFAULT_CHAT_LIMIT)
+            if value != _credential_cache['value']:
+                logger.debug("✅ OpenAI credentials loaded for model: %s", value[1])
+                logger.debug("✅ Chat limit loaded: %s", value[2])
+        
+    except Exception as e:
+        print(f"❌ Error loading AI credentials: {e}")
+        import traceback
+        traceback.print_exc()
+        # Keep serving the last known credentials (if any) until the next retry
+        value = _credential_cache['value']
+    
+    with _credential_lock:
+        _credential_cache['value'] = value
+        _credential_cache['ts'] = time.monotonic()
+        _credential_cache['loaded'] = True
+    return value
+
+
+def _escape_like(value):
+    """Escape LIKE wildcards so user input is matched literally"""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+# Shapes the (at most 10) matching offers into frontend-ready JSON inside PostgreSQL.
+# Timestamps are rendered by json_build_object in ISO 8601, like datetime.isoformat()
+_OFFER_JSON_SELECT = """
+    SELECT COALESCE(json_agg(json_build_object(
+        'id', r.id,
+        'title', r.title,
+        'description', r.description,
+        'keywords', r.keywords,
+        'city', r.city,
+        'category', r.category,
+        'address', r.address,
+        'isPremium', r.is_premium,
+        'isNationwide', r.is_nationwide,
+        'offerType', r.offer_type,
+        'cost', NULLIF(r.cost, 0)::float8,
+        'businessName', r.business_name,
+        'merchantName', r.business_name,
+        'phone', r.phone,
+        'email', r.email,
+        'expiresAt', r.expires_at,
+        'validUntil', r.expires_at,
+        'startsAt', r.starts_at,
+        'validFrom', r.starts_at,
+        'createdAt', r.created_at,
+        'approvedAt', r.approved_at,
+        'imageUrl', r.image_url,
+        'imageS3Key', r.image_s3_key,
+        'offerUrl', r.offer_url,
+        'website', r.offer_url,
+        'status', r.status,
+        'locationType', r.location_type,
+        'businessId', r.business_id
+    ) ORDER BY r.is_premium DESC, r.created_at DESC), '[]'::json)
+    FROM ({query}) AS r
+"""
+
+
+def _refresh_api_credentials():
+    """Background refresh for stale credentials"""
+    try:
+        _fetch_api_credentials()
+    finally:
+        with _credential_lock:
+            _credential_cache['refreshing'] = False
+
+
+# Built once at import - these are sent with every chat request.
+# Two narrow tools instead of one with four optional arguments
+_CITY_PARAMETER = {
+    "type": "string",
+    "description": "City name to filter offers by location (defaults to the user's city)"
+}
+
+_TOOL_DEFINITIONS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "search_offers_in_city",
+            "description": "Search deals and offers by keywords. Use this for most questions about discounts, deals, offers, products or business names.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "keywords": {
+                        "type": "string",
+                        "description": "Keywords to search in offer title, description and keywords column (e.g., 'computer', 'pizza', 'shoes', business names)"
+                    },
+                    "city": _CITY_PARAMETER
+                },
+                "required": ["keywords"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "search_offers_by_category",
+            "description": "List deals and offers in one product category. ONLY use this if the user clearly asks for a whole category; otherwise use search_offers_in_city with keywords.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "category": {
+                        "type": "string",
+                        "description": "Product category",
+                        "enum": ["food", "fashion", "electronics", "beauty", "sports", "home", "automotive", "travel", "entertainment", "Ruoka ja juoma", "Muoti", "Teknologia", "Kauneus", "Urheilu ja vapaa-aika", "Koti", "Autot", "Matkailu", "Viihde"]
+                    },
+                    "city": _CITY_PARAMETER
+                },
+                "required": ["category"]
+            }
+        }
+    }
+]
+
+# Tool name -> arguments it accepts, derived from the schema above
+_TOOL_ARGUMENTS = {
+    tool["function"]["name"]: frozenset(tool["function"]["parameters"]["properties"])
+    for tool in _TOOL_DEFINITIONS
+}
+
+_SYSTEM_MESSAGES = {
+    'fi': """Olet Etuhinta AI-avustaja, joka auttaa käyttäjiä löytämään parhaat tarjoukset ja alennukset Suomessa. 
+                
+TÄRKEÄÄ - OLE TIUKKA NÄISTÄ SÄÄNNÖISTÄ:
+1. Tervehdi käyttäjää ystävällisesti suomeksi
+2. Jos käyttäjä vain tervehtii (kuten "hei", "moi", "terve"), kysy mitä alennuksia tai tarjouksia he etsivät
+3. ETSI TARJOUKSIA KÄYTTÄJÄN KAUPUNGISTA TAI KOKO MAAN TARJOUKSIA:
+   - Näytä tarjoukset käyttäjän kaupungista
+   - Näytä tarjoukset jotka on merkitty "koko maa" (valtakunnalliset)
+   - Näytä tarjoukset jotka sisältävät käyttäjän kaupungin useamman kaupungin tarjouksissa
+4. Jos käyttäjä kysyy tarjouksista, käytä hakutyökaluja NÄIN:
+   - Yleisille termeille kuten "vaatteet", "ruoka", "teknologia" - käytä search_offers_in_city-työkalua hakusanoilla, ÄLÄ kategoriaa
+   - Vain erittäin spesifeille kategorioille käytä search_offers_by_category-työkalua
+   - Käytä AINA käyttäjän kaupunkia suodattimena
+5. KUN LÖYDÄT TARJOUKSIA:
+   - Kirjoita lyhyt, ystävällinen viesti jossa kerrot löytäneesi tarjouksia
+   - Tarjouskortit näkyvät automaattisesti viestin alapuolella
+   - Kannusta käyttäjää klikkaamaan tarjouskortteja saadakseen lisätietoja
+6. Jos et löydä tarjouksia käyttäjän kaupungista tai koko maan tarjouksia:
+   - Sano: "En löytänyt [hakutermi] tarjouksia tänään [käyttäjän kaupunki]:ssa tai koko maan tarjouksia"
+   - Ehdota vaihtoehtoisia hakutermejä samassa kaupungissa
+
+Vastaa aina suomeksi, ole ystävällinen ja auta löytämään parhaat tarjoukset.""",
+    'en': """You are Etuhinta's AI assistant, helping users find the best deals and discounts in Finland.
+
+IMPORTANT - BE STRICT ABOUT THESE RULES:
+1. Greet users friendly in English
+2. If user just greets (like "hi", "hello"), ask what kind of discounts or offers they're looking for
+3. SEARCH OFFERS IN USER'S CITY OR NATIONWIDE OFFERS:
+   - Show offers from user's city
+   - Show offers marked as "koko maa" (nationwide)
+   - Show offers that include user's city in multi-city listings
+4. When users ask about offers, use the search tools LIKE THIS:
+   - For general terms like "clothes", "food", "technology" - use search_offers_in_city with keywords, DON'T use category
+   - Only use search_offers_by_category for very specific categories
+   - ALWAYS use the user's city as filter
+5. WHEN YOU FIND OFFERS:
+   - Write a short, friendly message telling the user you found offers
+   - Offer cards will appear automatically below your message
+   - Encourage users to click on the offer cards for more details
+6. If no offers found in user's city or nationwide:
+   - Say: "I couldn't find [search term] offers today in [user's city] or nationwide offers"
+   - Suggest alternative search terms in the same city
+
+Always respond in English and be helpful in finding the best deals."""
+}
+
+_GREETINGS = frozenset({
+    "hei", "moi", "terve", "moikka", "hei hei", "moro", "heippa",
+    "hi", "hello", "hey", "hiya", "yo"
+})
+
+_GREETING_REPLIES = {
+    'fi': "Hei! 👋 Millaisia tarjouksia tai alennuksia etsit tänään?",
+    'en': "Hi! 👋 What kind of discounts or offers are you looking for today?"
+}
+
+_USER_CITY_TEMPLATES = {
+    'fi': "Käyttäjän kaupunki: {city}",
+    'en': "User's city: {city}"
+}
+
+# Replies after a search tool call (keeps to the system prompt's rules 5 and 6)
+_FOLLOW_UP_MESSAGES = {
+    'fi': {
+        'found': "Löysin sinulle {count} tarjousta! 🎉 Tarjouskortit näkyvät alla - klikkaa niitä saadaksesi lisätietoja.",
+        'not_found': "En löytänyt {keywords} tarjouksia tänään {city}:ssa tai koko maan tarjouksia. Kokeile toista hakusanaa, niin etsin uudelleen!"
+    },
+    'en': {
+        'found': "I found {count} offers for you! 🎉 The offer cards are shown below - click them for more details.",
+        'not_found': "I couldn't find {keywords} offers today in {city} or nationwide offers. Try a different search term and I'll look again!"
+    }
+}
+
+_FOLLOW_UP_DEFAULTS = {
+    'fi': {'keywords': 'tarjouksia', 'city': 'kaupungissasi'},
+    'en': {'keywords': 'any', 'city': 'your city'}
+}
 
 
 class AIChat:
+    DEFAULT_CHAT_LIMIT = DEFAULT_CHAT_LIMIT
+    _instance = None
+    _instance_lock = threading.Lock()
+
     def __init__(self):
-        """Initialize AI Chat with database connection"""
-        self.openai_client = None
-        self.api_key = None
-        self.model_name = None
-        self.chat_limit = None
-        self._load_api_credentials()
+        """Initialize AI Chat - credentials and the OpenAI client are loaded on first use"""
+        self._openai_client = None
+        self._client_api_key = None
+        self._client_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        """Return the process-wide AIChat instance"""
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
         
     def _load_api_credentials(self):
-        """Load OpenAI API credentials from database"""
-        try:
-            with get_db_connection() as conn:
-                with conn.cursor() as cursor:
-                    # Get OpenAI credentials including chat_limit
-                    cursor.execute("""
-                        SELECT api_key, model_name, chat_limit 
-                        FROM ai_model_credentials 
-                        WHERE service_name = 'OpenAI' 
-                        ORDER BY created_at DESC 
-                        LIMIT 1
-                    """)
-                    
-                    result = cursor.fetchone()
-                    
-                    if result:
-                        self.api_key = result[0]
-                        self.model_name = result[1] or 'gpt-4o'
-                        self.chat_limit = result[2] or 15  # Default to 15 if null
-                        
-                        # Initialize OpenAI client with modern API
-                        self.openai_client = openai.OpenAI(api_key=self.api_key)
-                        print(f"✅ OpenAI client initialized with model: {self.model_name}")
-                        print(f"✅ API key loaded: {self.api_key[:10]}...")
-                        print(f"✅ Chat limit loaded: {self.chat_limit}")
-                    else:
-                        print("❌ No OpenAI credentials found in database")
-                        self.chat_limit = 15  # Default fallback
-                        
-        except Exception as e:
-            print(f"❌ Error loading AI credentials: {e}")
-            self.chat_limit = 15  # Default fallback
-            import traceback
-            traceback.print_exc()
+        """Load OpenAI API credentials, served from the shared cache when possible
+        
+        Stale credentials are returned immediately while a background thread refreshes them.
+        """
+        with _credential_lock:
+            credentials = _credential_cache['value']
+            loaded = _credential_cache['loaded']
+            refresh = (loaded
+                       and time.monotonic() - _credential_cache['ts'] >= CRED_TTL_SECONDS
+                       and not _credential_cache['refreshing'])
+            if refresh:
+                _credential_cache['refreshing'] = True
+        
+        if not loaded:
+            credentials = _fetch_api_credentials()
+        elif refresh:
+            threading.Thread(target=_refresh_api_credentials, name="ai-credentials-refresh", daemon=True).start()
+        
+        return credentials
+
+    @property
+    def api_key(self):
+        credentials = self._load_api_credentials()
+        return credentials[0] if credentials else None
+
+    @property
+    def model_name(self):
+        credentials = self._load_api_credentials()
+        return credentials[1] if credentials else None
+
+    @property
+    def chat_limit(self):
+        credentials = self._load_api_credentials()
+        return credentials[2] if credentials else self.DEFAULT_CHAT_LIMIT
+
+    @property
+    def openai_client(self):
+        """OpenAI client, built on first use and rebuilt only if the API key changes"""
+        api_key = self.api_key
+        if not api_key:
+            return None
+        
+        with self._client_lock:
+            if self._openai_client is None or self._client_api_key != api_key:
+                self._openai_client = openai.OpenAI(
+                    api_key=api_key,
+                    timeout=OPENAI_TIMEOUT_SECONDS,
+                    max_retries=OPENAI_MAX_RETRIES,
+                    http_client=_openai_http_client
+                )
+                self._client_api_key = api_key
+                logger.debug("✅ OpenAI client initialized")
+            return self._openai_client
             
     def search_offers_function(self, category: str = None, keywords: str = None, 
                              city: str = None, active_only: bool = True) -> List[Dict]:
@@ -58,25 +340,44 @@ class AIChat:
         Search offers based on AI-extracted parameters
         This function will be called by GPT-4 when users ask about deals/offers
         """
+        cache_key = (
+            category.strip().lower() if category else None,
+            ' '.join(keywords.lower().split()) if keywords else None,
+            city.strip().lower() if city else None,
+            active_only
+        )
+        cached = _offer_search_cache.get(cache_key)
+        if cached is not None:
+            logger.debug("✅ Found %d offers (cached)", len(cached))
+            return cached
+        
         try:
-            with get_db_connection() as conn:
-                with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            with get_db_connection(autocommit=True) as conn:
+                with conn.cursor() as cursor:
                     
                     # Build dynamic query with JOIN to get business information
                     # Search in title, description, and keywords columns for offers
                     base_query = """
-                        SELECT o.*, b.business_name, b.phone, b.email
+                        SELECT o.id, o.title, o.description, o.keywords, o.city, o.category, o.address,
+                               o.is_premium, o.is_nationwide, o.offer_type, o.cost,
+                               o.expires_at, o.starts_at, o.created_at, o.approved_at,
+                               o.image_url, o.image_s3_key, o.offer_url, o.status, o.location_type, o.business_id,
+                               b.business_name, b.phone, b.email
                         FROM offers o
                         LEFT JOIN businesses b ON o.business_id = b.id
                         WHERE o.status = 'approved'
-                        AND (o.expires_at IS NULL OR o.expires_at >= %s)
+                        AND (o.expires_at IS NULL OR o.expires_at >= NOW())
                     """
-                    params = [datetime.now()]
+                    params = []
                     
-                    if keywords:
-                        base_query += " AND (LOWER(o.title) LIKE LOWER(%s) OR LOWER(o.description) LIKE LOWER(%s) OR LOWER(o.keywords) LIKE LOWER(%s))"
-                        search_pattern = f"%{keywords}%"
-                        params.extend([search_pattern, search_pattern, search_pattern])
+                    terms = keywords.split() if keywords else []
+                    if terms:
+                        # ILIKE on the bare columns can use the pg_trgm GIN indexes;
+                        # every word must match so the planner can AND the bitmaps
+                        for term in terms:
+                            base_query += " AND (o.title ILIKE %s OR o.description ILIKE %s OR o.keywords ILIKE %s)"
+                            search_pattern = f"%{_escape_like(term)}%"
+                            params.extend([search_pattern, search_pattern, search_pattern])
                     
                     if category:
                         base_query += " AND LOWER(o.category) = LOWER(%s)"
@@ -87,76 +388,41 @@ class AIChat:
                         # 1. Plain text: "koko maa", "Helsinki"  
                         # 2. JSON arrays: ["Koko maa"], ["Helsinki"], ["Espoo,Aura,Helsinki"]
                         # 3. Comma-separated: "Espoo,Aura,Helsinki"
+                        # City is normalized here once; only equality and LIKE run per row
+                        city_normalized = city.strip().lower()
                         base_query += """ AND (
-                            LOWER(TRIM(o.city)) = 'koko maa' OR 
-                            LOWER(TRIM(o.city)) = LOWER(TRIM(%s)) OR 
-                            LOWER(o.city) ~ ('(^|,)\\s*' || LOWER(TRIM(%s)) || '\\s*(,|$)') OR
-                            LOWER(o.city) ~ ('\\[".*koko maa.*"\\]') OR
-                            LOWER(o.city) ~ ('\\[".*' || LOWER(TRIM(%s)) || '.*"\\]') OR
-                            LOWER(o.city) ~ ('".*' || LOWER(TRIM(%s)) || '.*"')
+                            LOWER(TRIM(o.city)) IN ('koko maa', %s) OR 
+                            LOWER(o.city) LIKE '%%["%%koko maa%%"]%%' OR
+                            LOWER(o.city) LIKE %s OR
+                            EXISTS (
+                                SELECT 1 FROM unnest(string_to_array(LOWER(o.city), ',')) AS city_part
+                                WHERE TRIM(city_part) = %s
+                            )
                         )"""
-                        params.extend([city, city, city, city])
+                        params.extend([
+                            city_normalized,
+                            f'%"%{_escape_like(city_normalized)}%"%',
+                            city_normalized
+                        ])
                         
                     # Order by premium first, then by creation date - ENSURES PREMIUM OFFERS APPEAR FIRST
                     base_query += " ORDER BY o.is_premium DESC, o.created_at DESC LIMIT 10"
                     
-                    print(f"🔍 Executing query with city filter (including koko maa and multi-city): {city}")
-                    print(f"🔍 Keywords searching in title/description/keywords: {keywords}")
-                    print(f"🔍 Query: {base_query}")
-                    print(f"🔍 Params: {params}")
+                    logger.debug("🔍 Searching offers - city: %s, keywords: %s", city, keywords)
+                    logger.debug("🔍 Query: %s", base_query)
+                    logger.debug("🔍 Params: %s", params)
                     
-                    cursor.execute(base_query, params)
-                    offers = cursor.fetchall()
+                    # The query text only depends on which filters are present, so each
+                    # shape is PREPAREd once per connection and its plan reused
+                    plan_name = f"ai_offers_k{len(terms)}_c{int(bool(category))}_t{int(bool(city))}"
                     
-                    print(f"✅ Found {len(offers)} offers")
+                    # PostgreSQL returns the list of frontend-shaped offers as one JSON value
+                    execute_prepared(cursor, plan_name, _OFFER_JSON_SELECT.format(query=base_query), params)
+                    offer_list = cursor.fetchone()[0]
                     
-                    # Convert to list of dictionaries with frontend-compatible field names
-                    offer_list = []
-                    for offer in offers:
-                        offer_dict = dict(offer)
-                        
-                        # Map database fields to frontend expected fields
-                        frontend_offer = {
-                            'id': offer_dict.get('id'),
-                            'title': offer_dict.get('title'),
-                            'description': offer_dict.get('description'),
-                            'keywords': offer_dict.get('keywords'),
-                            'city': offer_dict.get('city'),
-                            'category': offer_dict.get('category'),
-                            'address': offer_dict.get('address'),
-                            'isPremium': offer_dict.get('is_premium', False),
-                            'isNationwide': offer_dict.get('is_nationwide', False),
-                            'offerType': offer_dict.get('offer_type'),
-                            'cost': float(offer_dict.get('cost')) if offer_dict.get('cost') else None,
-                            
-                            # Map business fields
-                            'businessName': offer_dict.get('business_name'),
-                            'merchantName': offer_dict.get('business_name'),
-                            'phone': offer_dict.get('phone'),
-                            'email': offer_dict.get('email'),
-                            
-                            # Map date fields
-                            'expiresAt': offer_dict.get('expires_at').isoformat() if offer_dict.get('expires_at') else None,
-                            'validUntil': offer_dict.get('expires_at').isoformat() if offer_dict.get('expires_at') else None,
-                            'startsAt': offer_dict.get('starts_at').isoformat() if offer_dict.get('starts_at') else None,
-                            'validFrom': offer_dict.get('starts_at').isoformat() if offer_dict.get('starts_at') else None,
-                            'createdAt': offer_dict.get('created_at').isoformat() if offer_dict.get('created_at') else None,
-                            'approvedAt': offer_dict.get('approved_at').isoformat() if offer_dict.get('approved_at') else None,
-                            
-                            # Map image and URL fields
-                            'imageUrl': offer_dict.get('image_url'),
-                            'imageS3Key': offer_dict.get('image_s3_key'),
-                            'offerUrl': offer_dict.get('offer_url'),
-                            'website': offer_dict.get('offer_url'),  # Use offer_url as website
-                            
-                            # Map other fields
-                            'status': offer_dict.get('status'),
-                            'locationType': offer_dict.get('location_type'),
-                            'businessId': offer_dict.get('business_id')
-                        }
-                        
-                        offer_list.append(frontend_offer)
-                        
+                    logger.debug("✅ Found %d offers", len(offer_list))
+                    
+                    _offer_search_cache.set(cache_key, offer_list)
                     return offer_list
             
         except Exception as e:
@@ -165,47 +431,33 @@ class AIChat:
             traceback.print_exc()
             return []
     
+    @staticmethod
+    def preload_credentials():
+        """Fetch credentials in the background at startup so the first chat skips the query"""
+        threading.Thread(target=_fetch_api_credentials, name="ai-credentials-preload", daemon=True).start()
+
+    @staticmethod
+    def clear_search_cache():
+        """Invalidate cached offer searches (call after offers are approved or expired)"""
+        _offer_search_cache.clear()
+    
     def get_tool_definitions(self) -> List[Dict]:
         """Define the tool schema for OpenAI tools (modern API)"""
-        return [
-            {
-                "type": "function",
-                "function": {
-                    "name": "search_offers",
-                    "description": "Search for deals and offers based on user criteria. Use this when users ask about discounts, deals, offers, or specific products/categories. If you're not sure about the category, don't specify it - search broadly with keywords only.",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "category": {
-                                "type": "string",
-                                "description": "Product category - ONLY use if you're certain about the category. For unknown items, leave this empty and use keywords instead.",
-                                "enum": ["food", "fashion", "electronics", "beauty", "sports", "home", "automotive", "travel", "entertainment", "Ruoka ja juoma", "Muoti", "Teknologia", "Kauneus", "Urheilu ja vapaa-aika", "Koti", "Autot", "Matkailu", "Viihde"]
-                            },
-                            "keywords": {
-                                "type": "string",
-                                "description": "Keywords to search in offer title, description, keywords column, and business name (e.g., 'computer', 'pizza', 'shoes', business names)"
-                            },
-                            "city": {
-                                "type": "string",
-                                "description": "City name to filter offers by location"
-                            },
-                            "active_only": {
-                                "type": "boolean",
-                                "description": "Whether to show only currently active offers",
-                                "default": True
-                            }
-                        },
-                        "required": []
-                    }
-                }
-            }
-        ]
+        return _TOOL_DEFINITIONS
     
     def process_chat_message(self, user_message: str, user_city: str = None, 
                            language: str = 'en') -> Dict[str, Any]:
         """
         Process user message through OpenAI and handle tool calling
         """
+        # Plain greetings get the canned reply the system prompt asks for, without an API call
+        if user_message.strip().strip('!.?, ').lower() in _GREETINGS:
+            return {
+                'success': True,
+                'message': _GREETING_REPLIES['fi' if language == 'fi' else 'en'],
+                'offers': []
+            }
+        
         if not self.openai_client:
             return {
                 'success': False,
@@ -215,65 +467,15 @@ class AIChat:
             
         try:
             # Prepare system message based on language
-            if language == 'fi':
-                system_message = """Olet Etuhinta AI-avustaja, joka auttaa käyttäjiä löytämään parhaat tarjoukset ja alennukset Suomessa. 
-                
-TÄRKEÄÄ - OLE TIUKKA NÄISTÄ SÄÄNNÖISTÄ:
-1. Tervehdi käyttäjää ystävällisesti suomeksi
-2. Jos käyttäjä vain tervehtii (kuten "hei", "moi", "terve"), kysy mitä alennuksia tai tarjouksia he etsivät
-3. ETSI TARJOUKSIA KÄYTTÄJÄN KAUPUNGISTA TAI KOKO MAAN TARJOUKSIA:
-   - Näytä tarjoukset käyttäjän kaupungista
-   - Näytä tarjoukset jotka on merkitty "koko maa" (valtakunnalliset)
-   - Näytä tarjoukset jotka sisältävät käyttäjän kaupungin useamman kaupungin tarjouksissa
-4. Jos käyttäjä kysyy tarjouksista, käytä search_offers-työkalua NÄIN:
-   - Yleisille termeille kuten "vaatteet", "ruoka", "teknologia" - käytä VAIN keywords, ÄLÄ kategoriaa
-   - Vain erittäin spesifeille kategorioille käytä category-kenttää
-   - Käytä AINA käyttäjän kaupunkia suodattimena
-5. KUN LÖYDÄT TARJOUKSIA:
-   - Kirjoita lyhyt, ystävällinen viesti jossa kerrot löytäneesi tarjouksia
-   - Tarjouskortit näkyvät automaattisesti viestin alapuolella
-   - Kannusta käyttäjää klikkaamaan tarjouskortteja saadakseen lisätietoja
-6. Jos et löydä tarjouksia käyttäjän kaupungista tai koko maan tarjouksia:
-   - Sano: "En löytänyt [hakutermi] tarjouksia tänään [käyttäjän kaupunki]:ssa tai koko maan tarjouksia"
-   - Ehdota vaihtoehtoisia hakutermejä samassa kaupungissa
-
-Vastaa aina suomeksi, ole ystävällinen ja auta löytämään parhaat tarjoukset."""
-            else:
-                system_message = """You are Etuhinta's AI assistant, helping users find the best deals and discounts in Finland.
-
-IMPORTANT - BE STRICT ABOUT THESE RULES:
-1. Greet users friendly in English
-2. If user just greets (like "hi", "hello"), ask what kind of discounts or offers they're looking for
-3. SEARCH OFFERS IN USER'S CITY OR NATIONWIDE OFFERS:
-   - Show offers from user's city
-   - Show offers marked as "koko maa" (nationwide)
-   - Show offers that include user's city in multi-city listings
-4. When users ask about offers, use the search_offers tool LIKE THIS:
-   - For general terms like "clothes", "food", "technology" - use ONLY keywords, DON'T use category
-   - Only use category field for very specific categories
-   - ALWAYS use the user's city as filter
-5. WHEN YOU FIND OFFERS:
-   - Write a short, friendly message telling the user you found offers
-   - Offer cards will appear automatically below your message
-   - Encourage users to click on the offer cards for more details
-6. If no offers found in user's city or nationwide:
-   - Say: "I couldn't find [search term] offers today in [user's city] or nationwide offers"
-   - Suggest alternative search terms in the same city
-
-Always respond in English and be helpful in finding the best deals."""
-            
-            # Prepare messages for OpenAI
-            messages = [
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": user_message}
-            ]
+            lang = 'fi' if language == 'fi' else 'en'
+            system_message = _SYSTEM_MESSAGES[lang]
             
-            # Add user city context if available
+            # Prepare messages for OpenAI - the system prompt is sent verbatim so the
+            # provider can prompt-cache it; the user's city goes in its own message
+            messages = [{"role": "system", "content": system_message}]
             if user_city:
-                if language == 'fi':
-                    messages[0]["content"] += f"\n\nKäyttäjän kaupunki: {user_city}"
-                else:
-                    messages[0]["content"] += f"\n\nUser's city: {user_city}"
+                messages.append({"role": "system", "content": _USER_CITY_TEMPLATES[lang].format(city=user_city)})
+            messages.append({"role": "user", "content": user_message})
             
             # Call OpenAI with modern tools API
             response = self.openai_client.chat.completions.create(
@@ -289,11 +491,17 @@ Always respond in English and be helpful in finding the best deals."""
             offers = []
             
             # Handle tool calling
+            ai_message = message.content
             if message.tool_calls:
                 # Process tool calls
                 for tool_call in message.tool_calls:
-                    if tool_call.function.name == "search_offers":
-                        function_args = json.loads(tool_call.function.arguments)
+                    allowed_args = _TOOL_ARGUMENTS.get(tool_call.function.name)
+                    if allowed_args is not None:
+                        # Drop any argument the model invents that the tool doesn't take
+                        function_args = {
+                            key: value for key, value in orjson.loads(tool_call.function.arguments).items()
+                            if key in allowed_args
+                        }
                         
                         # Add user city if not specified in function args
                         if user_city and not function_args.get('city'):
@@ -301,41 +509,20 @@ Always respond in English and be helpful in finding the best deals."""
                             
                         offers = self.search_offers_function(**function_args)
                         
-                        # Generate follow-up response with search results
+                        # Reply from a template instead of a second OpenAI round-trip
                         if offers:
-                            if language == 'fi':
-                                follow_up_prompt = f"Löysin {len(offers)} tarjousta. Kirjoita lyhyt, ystävällinen viesti jossa kerrot löytäneesi tarjouksia ja kannustat käyttäjää katsomaan niitä. Pidä viesti lyhyenä ja positiivisena."
-                            else:
-                                follow_up_prompt = f"I found {len(offers)} offers. Write a short, friendly message telling the user you found offers and encourage them to check them out. Keep the message brief and positive."
+                            ai_message = _FOLLOW_UP_MESSAGES[lang]['found'].format(count=len(offers))
                         else:
-                            if language == 'fi':
-                                follow_up_prompt = f"En löytänyt {function_args.get('keywords', 'tarjouksia')} tarjouksia tänään {function_args.get('city', 'käyttäjän kaupungissa')}:ssa tai koko maan tarjouksia. Ehdota vaihtoehtoisia hakutermejä samassa kaupungissa tai koko maassa."
-                            else:
-                                follow_up_prompt = f"I couldn't find {function_args.get('keywords', 'offers')} offers today in {function_args.get('city', 'user city')} or nationwide offers. Suggest alternative search terms in the same city or nationwide."
-                        
-                        # Generate final response with context
-                        final_messages = messages + [
-                            {"role": "assistant", "content": message.content, "tool_calls": message.tool_calls},
-                            {"role": "tool", "tool_call_id": tool_call.id, "content": json.dumps({"offers_count": len(offers)})},
-                            {"role": "user", "content": follow_up_prompt}
-                        ]
-                        
-                        final_response = self.openai_client.chat.completions.create(
-                            model=self.model_name,
-                            messages=final_messages,
-                            temperature=0.7,
-                            max_tokens=300
-                        )
-                        
-                        ai_message = final_response.choices[0].message.content
+                            defaults = _FOLLOW_UP_DEFAULTS[lang]
+                            ai_message = _FOLLOW_UP_MESSAGES[lang]['not_found'].format(
+                                keywords=function_args.get('keywords') or function_args.get('category') or defaults['keywords'],
+                                city=function_args.get('city') or defaults['city']
+                            )
                         break
-            else:
-                ai_message = message.content
                 
-            print(f"🎯 Final AI response:")
-            print(f"   Message: {ai_message}")
-            print(f"   Offers count: {len(offers)}")
-            print(f"   Offers data: {offers}")
+            logger.debug("🎯 Final AI response: %s", ai_message)
+            # Only a sample of the offers - the full list repr can be large
+            logger.debug("   Offers count: %d, first offers: %s", len(offers), offers[:2])
                 
             return {
                 'success': True,
@@ -354,4 +541,4 @@ Always respond in English and be helpful in finding the best deals."""
 
     def get_chat_limit(self):
         """Get the current chat limit from database"""
-        return getattr(self, 'chat_limit', 15) 
\ No newline at end of file
+        return self.chat_limit 
\ No newline at end of file
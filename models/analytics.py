@@ -1,33 +1,94 @@
+import atexit
+import io
+import queue
+import threading
+import time
 import uuid
-from datetime import datetime, date
-from config.database import get_db_connection
+from collections import Counter
+from datetime import datetime, date, timedelta
+from config.database import get_db_connection, get_analytics_db_connection, execute_prepared, create_index_concurrently
+from utils.cache import TTLCache
 import psycopg2.extras
-import json
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import orjson
+
+# Businesses whose active_offers count was refreshed recently - the count is
+# recomputed in the background at most once per business per 5 minutes
+_active_offers_refreshed = TTLCache(maxsize=4096, ttl=300)
+
+# offer_id -> business_id (0 when the offer doesn't exist); offers never change business
+_offer_business_cache = TTLCache(maxsize=100000, ttl=3600)
+
+# Fire-and-forget tracking is queued in memory and written by one background
+# drainer in micro-batches (every 200ms, at most 10 000 items per batch)
+TRACKING_FLUSH_INTERVAL = 0.2
+TRACKING_FLUSH_MAX_ITEMS = 10000
+_tracking_queue = queue.Queue()
+_tracking_lock = threading.Lock()
+_tracking_drainer = None
+
+# Rows per UNNEST insert into analytics_events
+EVENT_INSERT_CHUNK_SIZE = 10000
+
+# analytics_events is range-partitioned by day; partitions are pre-created this
+# many days ahead (checked once per day per process)
+EVENT_PARTITION_DAYS_AHEAD = 7
+_partitions_ensured_on = None
+
+# Batches at least this large are loaded with COPY instead of INSERT
+EVENT_COPY_THRESHOLD = 5000
+
+# Closed days are rolled into analytics_daily_stats by the tracking drainer, at
+# most once per interval per process and only DAILY_ROLLUP_GRACE after midnight,
+# so events still queued or in flight when the day closed have landed
+DAILY_ROLLUP_GRACE = timedelta(hours=1)
+DAILY_ROLLUP_CHECK_INTERVAL = 600
+_rollup_checked_at = None
+
+class _OrjsonJson(psycopg2.extras.Json):
+    """psycopg2 JSON adapter that serializes with orjson"""
+
+    def dumps(self, obj):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+_COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+def _copy_text_value(value):
+    """Format a value for COPY ... FROM STDIN WITH (FORMAT text)"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, psycopg2.extras.Json):
+        value = value.dumps(value.adapted)
+    return str(value).translate(_COPY_ESCAPES)
 
 class Analytics:
-    # Thread pool executor for async operations
-    _executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="analytics")
-    
     @staticmethod
     def create_tables():
         """Create analytics tables if they don't exist"""
         query = """
         DROP TABLE IF EXISTS analytics_events CASCADE;
         DROP TABLE IF EXISTS analytics_daily_stats CASCADE;
+        DROP TABLE IF EXISTS analytics_sessions CASCADE;
+        DROP TABLE IF EXISTS offer_daily_stats CASCADE;
         
         CREATE TABLE analytics_events (
-            id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+            id UUID NOT NULL DEFAULT gen_random_uuid(),
             event_type VARCHAR(50) NOT NULL,
             session_id VARCHAR(255),
             user_id INTEGER REFERENCES users(id) ON DELETE SET NULL,
             offer_id INTEGER REFERENCES offers(id) ON DELETE SET NULL,
+            business_id INTEGER,
             metadata JSONB,
             ip_address INET,
             user_agent TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at);
+        
+        -- Catches events outside the pre-created daily partitions
+        CREATE TABLE analytics_events_default PARTITION OF analytics_events DEFAULT;
         
         CREATE TABLE analytics_daily_stats (
             id SERIAL PRIMARY KEY,
@@ -38,16 +99,40 @@ class Analytics:
             unique_users INTEGER DEFAULT 0,
             top_categories JSONB,
             top_merchants JSONB,
+            event_type_counts JSONB,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
         
+        CREATE TABLE analytics_sessions (
+            session_id VARCHAR(255) PRIMARY KEY,
+            city VARCHAR(255),
+            user_id INTEGER,
+            first_seen TIMESTAMP NOT NULL,
+            last_seen TIMESTAMP NOT NULL,
+            event_count INTEGER DEFAULT 0,
+            duration_seconds DOUBLE PRECISION DEFAULT 0
+        );
+        
+        CREATE TABLE offer_daily_stats (
+            offer_id INTEGER NOT NULL,
+            date DATE NOT NULL,
+            event_type VARCHAR(50) NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (offer_id, date, event_type)
+        );
+        
         CREATE INDEX IF NOT EXISTS idx_analytics_events_type ON analytics_events(event_type);
         CREATE INDEX IF NOT EXISTS idx_analytics_events_session ON analytics_events(session_id);
         CREATE INDEX IF NOT EXISTS idx_analytics_events_user ON analytics_events(user_id);
         CREATE INDEX IF NOT EXISTS idx_analytics_events_offer ON analytics_events(offer_id);
+        CREATE INDEX IF NOT EXISTS idx_analytics_events_business ON analytics_events(business_id);
         CREATE INDEX IF NOT EXISTS idx_analytics_events_created_at ON analytics_events(created_at);
+        CREATE INDEX IF NOT EXISTS idx_analytics_events_metadata_gin ON analytics_events USING GIN (metadata jsonb_path_ops);
+        CREATE INDEX IF NOT EXISTS idx_analytics_events_city ON analytics_events ((metadata->>'city'));
         CREATE INDEX IF NOT EXISTS idx_analytics_daily_stats_date ON analytics_daily_stats(date);
+        CREATE INDEX IF NOT EXISTS idx_analytics_sessions_last_seen ON analytics_sessions(last_seen);
+        CREATE INDEX IF NOT EXISTS idx_offer_daily_stats_date ON offer_daily_stats(date, event_type);
         """
         
         try:
@@ -55,11 +140,155 @@ class Analytics:
                 with conn.cursor() as cursor:
                     cursor.execute(query)
                     conn.commit()
+            Analytics.ensure_event_partitions(force=True)
             print('✅ Analytics tables created successfully')
         except Exception as error:
             print(f'❌ Error creating analytics tables: {error}')
             raise error
 
+    @staticmethod
+    def update_database_schema():
+        """Add columns and tables introduced after analytics tables were first created
+        
+        offer_daily_stats is backfilled from analytics_events when it is first
+        created, so the dashboard's top offers cover days before the deploy.
+        """
+        try:
+            with get_db_connection() as conn:
+                with conn.cursor() as cursor:
+                    # Serialize concurrent migrations
+                    cursor.execute("SELECT pg_advisory_xact_lock(hashtext('offer_daily_stats'))")
+                    cursor.execute("SELECT to_regclass('offer_daily_stats') IS NULL")
+                    created = cursor.fetchone()[0]
+                    
+                    cursor.execute("""
+                        ALTER TABLE analytics_daily_stats
+                        ADD COLUMN IF NOT EXISTS event_type_counts JSONB
+                    """)
+                    cursor.execute("""
+                        ALTER TABLE analytics_events
+                        ADD COLUMN IF NOT EXISTS business_id INTEGER
+                    """)
+                    cursor.execute("""
+                        CREATE TABLE IF NOT EXISTS analytics_sessions (
+                            session_id VARCHAR(255) PRIMARY KEY,
+                            city VARCHAR(255),
+                            user_id INTEGER,
+                            first_seen TIMESTAMP NOT NULL,
+                            last_seen TIMESTAMP NOT NULL,
+                            event_count INTEGER DEFAULT 0,
+                            duration_seconds DOUBLE PRECISION DEFAULT 0
+                        )
+                    """)
+                    cursor.execute("""
+                        CREATE INDEX IF NOT EXISTS idx_analytics_sessions_last_seen ON analytics_sessions(last_seen)
+                    """)
+                    if created:
+                        # Keep event writers out until the backfill below is committed
+                        cursor.execute("LOCK TABLE analytics_events IN SHARE ROW EXCLUSIVE MODE")
+                    
+                    cursor.execute("""
+                        CREATE TABLE IF NOT EXISTS offer_daily_stats (
+                            offer_id INTEGER NOT NULL,
+                            date DATE NOT NULL,
+                            event_type VARCHAR(50) NOT NULL,
+                            count INTEGER NOT NULL DEFAULT 0,
+                            PRIMARY KEY (offer_id, date, event_type)
+                        )
+                    """)
+                    cursor.execute("""
+                        CREATE INDEX IF NOT EXISTS idx_offer_daily_stats_date ON offer_daily_stats(date, event_type)
+                    """)
+                    
+                    if created:
+                        cursor.execute("""
+                            INSERT INTO offer_daily_stats (offer_id, date, event_type, count)
+                            SELECT offer_id, created_at::date, event_type, COUNT(*)
+                            FROM analytics_events
+                            WHERE offer_id IS NOT NULL
+                            GROUP BY 1, 2, 3
+                        """)
+                    conn.commit()
+            
+            print('✅ Analytics schema up to date')
+            
+        except Exception as error:
+            print(f'❌ Error updating analytics schema: {error}')
+            raise error
+
+    @staticmethod
+    def create_indexes():
+        """Create the business_analytics upsert key and the analytics_events metadata indexes"""
+        indexes = [
+            ('business_analytics_business_date_key',
+             "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS business_analytics_business_date_key ON business_analytics (business_id, date)"),
+            ('idx_analytics_events_business',
+             "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_analytics_events_business ON analytics_events (business_id)"),
+            ('idx_analytics_events_metadata_gin',
+             "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_analytics_events_metadata_gin ON analytics_events USING GIN (metadata jsonb_path_ops)"),
+            # Location/city analytics group by the city stored in metadata
+            ('idx_analytics_events_city',
+             "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_analytics_events_city ON analytics_events ((metadata->>'city'))"),
+        ]
+        
+        try:
+            # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+            with get_db_connection(autocommit=True) as conn:
+                with conn.cursor() as cursor:
+                    # Partitioned tables can't be indexed CONCURRENTLY; create_tables
+                    # already defines these indexes on the partitioned parent
+                    partitioned = Analytics._events_partitioned(cursor)
+                    for name, statement in indexes:
+                        if partitioned and ' ON analytics_events ' in statement:
+                            continue
+                        create_index_concurrently(cursor, name, statement)
+            
+            print('✅ Analytics indexes ready')
+            
+        except Exception as error:
+            print(f'❌ Error creating analytics indexes: {error}')
+            raise error
+
+    @staticmethod
+    def _events_partitioned(cursor):
+        """Whether analytics_events is a partitioned table (created by create_tables)"""
+        cursor.execute("""
+            SELECT EXISTS (
+                SELECT 1 FROM pg_partitioned_table
+                WHERE partrelid = to_regclass('analytics_events')
+            )
+        """)
+        return cursor.fetchone()[0]
+
+    @staticmethod
+    def ensure_event_partitions(force=False):
+        """Create daily analytics_events partitions from today through EVENT_PARTITION_DAYS_AHEAD
+        
+        Runs at most once per day per process unless forced; a no-op when
+        analytics_events isn't partitioned.
+        """
+        global _partitions_ensured_on
+        today = date.today()
+        if _partitions_ensured_on == today and not force:
+            return
+        
+        try:
+            with get_db_connection() as conn:
+                with conn.cursor() as cursor:
+                    if Analytics._events_partitioned(cursor):
+                        for offset in range(EVENT_PARTITION_DAYS_AHEAD + 1):
+                            day = today + timedelta(days=offset)
+                            cursor.execute(f"""
+                                CREATE TABLE IF NOT EXISTS analytics_events_p{day:%Y%m%d}
+                                PARTITION OF analytics_events
+                                FOR VALUES FROM ('{day.isoformat()}') TO ('{(day + timedelta(days=1)).isoformat()}')
+                            """)
+                    conn.commit()
+            # Only marked once the partitions are committed, so a failure retries on the next event
+            _partitions_ensured_on = today
+        except Exception as error:
+            print(f'❌ Error creating analytics event partitions: {error}')
+
     @staticmethod
     def batch_track_events(events_data):
         """Batch track multiple analytics events in a single query"""
@@ -68,10 +297,11 @@ class Analytics:
                 return
                 
             event_date = date.today()
+            Analytics.ensure_event_partitions()
+            business_mapping = Analytics._resolve_businesses(event.get('offer_id') for event in events_data)
             
             # Prepare data for batch insert
             analytics_values = []
-            business_updates = {}  # Track business analytics updates
             
             for event in events_data:
                 event_type = event.get('event_type')
@@ -84,108 +314,235 @@ class Analytics:
                 
                 # Add to batch insert data
                 analytics_values.append((
-                    event_type, session_id, user_id, offer_id, 
-                    json.dumps(metadata) if metadata else None, 
+                    event_type, session_id, user_id, offer_id, business_mapping.get(offer_id),
+                    _OrjsonJson(metadata) if metadata else None, 
                     ip_address, user_agent
                 ))
-                
-                # Track business analytics updates
-                if offer_id and event_type in ['view', 'click', 'conversion']:
-                    if offer_id not in business_updates:
-                        business_updates[offer_id] = {'view': 0, 'click': 0, 'conversion': 0}
-                    business_updates[offer_id][event_type] += 1
             
-            # Single batch insert for analytics_events using execute_values
-            with get_db_connection() as conn:
+            # created_at is left to the column's DEFAULT CURRENT_TIMESTAMP
+            with get_analytics_db_connection() as conn:
                 with conn.cursor() as cursor:
-                    psycopg2.extras.execute_values(
-                        cursor,
-                        """INSERT INTO analytics_events (event_type, session_id, user_id, offer_id, metadata, ip_address, user_agent, created_at)
-                           VALUES %s""",
-                        [(event_type, session_id, user_id, offer_id, metadata, ip_address, user_agent, datetime.now()) 
-                         for event_type, session_id, user_id, offer_id, metadata, ip_address, user_agent in analytics_values],
-                        template=None,
-                        page_size=100
-                    )
+                    if len(analytics_values) >= EVENT_COPY_THRESHOLD:
+                        # Large bursts: stream the rows through COPY
+                        buffer = io.StringIO()
+                        for row in analytics_values:
+                            buffer.write('\t'.join(_copy_text_value(value) for value in row))
+                            buffer.write('\n')
+                        buffer.seek(0)
+                        cursor.copy_expert("""
+                            COPY analytics_events (event_type, session_id, user_id, offer_id, business_id, metadata, ip_address, user_agent)
+                            FROM STDIN WITH (FORMAT text)
+                        """, buffer)
+                    else:
+                        # Insert with one UNNEST statement per chunk - each column
+                        # is sent as a single array, so there's no per-row parameter cap
+                        for start in range(0, len(analytics_values), EVENT_INSERT_CHUNK_SIZE):
+                            columns = list(zip(*analytics_values[start:start + EVENT_INSERT_CHUNK_SIZE]))
+                            cursor.execute("""
+                                INSERT INTO analytics_events (event_type, session_id, user_id, offer_id, business_id, metadata, ip_address, user_agent)
+                                SELECT event_type, session_id, user_id, offer_id, business_id, metadata, ip_address, user_agent
+                                FROM UNNEST(%s::varchar[], %s::varchar[], %s::int[], %s::int[], %s::int[], %s::jsonb[], %s::inet[], %s::text[])
+                                    AS e(event_type, session_id, user_id, offer_id, business_id, metadata, ip_address, user_agent)
+                            """, [list(column) for column in columns])
+                    Analytics._update_sessions(cursor, events_data)
                     conn.commit()
             
             # Batch update business analytics
-            Analytics._batch_update_business_analytics(business_updates, event_date)
+            Analytics._batch_update_business_analytics(
+                Analytics._count_offer_events(events_data, business_mapping), business_mapping, event_date
+            )
                 
         except Exception as error:
             print(f'❌ Error in batch_track_events: {error}')
             # Don't raise the error to avoid breaking the main application flow
             pass
 
+    @staticmethod
+    def _update_sessions(cursor, events_data):
+        """Fold a batch of events into the analytics_sessions summary with one UPSERT"""
+        sessions = {}
+        for event in events_data:
+            session_id = event.get('session_id')
+            if not session_id:
+                continue
+            metadata = event.get('metadata')
+            city = metadata.get('city') if isinstance(metadata, dict) else None
+            summary = sessions.get(session_id)
+            if summary is None:
+                sessions[session_id] = [city, event.get('user_id'), 1]
+            else:
+                summary[0] = summary[0] or city
+                summary[1] = summary[1] or event.get('user_id')
+                summary[2] += 1
+        
+        if not sessions:
+            return
+        
+        psycopg2.extras.execute_values(
+            cursor,
+            """INSERT INTO analytics_sessions (session_id, city, user_id, first_seen, last_seen, event_count, duration_seconds)
+               VALUES %s
+               ON CONFLICT (session_id) DO UPDATE
+                           SET city = COALESCE(analytics_sessions.city, EXCLUDED.city),
+                               user_id = COALESCE(analytics_sessions.user_id, EXCLUDED.user_id),
+                               first_seen = LEAST(analytics_sessions.first_seen, EXCLUDED.first_seen),
+                               last_seen = GREATEST(analytics_sessions.last_seen, EXCLUDED.last_seen),
+                               event_count = analytics_sessions.event_count + EXCLUDED.event_count,
+                               duration_seconds = EXTRACT(EPOCH FROM (
+                                   GREATEST(analytics_sessions.last_seen, EXCLUDED.last_seen)
+                                   - LEAST(analytics_sessions.first_seen, EXCLUDED.first_seen)
+                               ))""",
+            [(session_id, city, user_id, count) for session_id, (city, user_id, count) in sessions.items()],
+            template="(%s, %s, %s, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, %s, 0)",
+            page_size=1000
+        )
+
+    @staticmethod
+    def _count_offer_events(events_data, business_mapping):
+        """Count events per (offer_id, event_type) for existing offers in one pass"""
+        return Counter(
+            (event.get('offer_id'), event.get('event_type'))
+            for event in events_data
+            if event.get('offer_id') in business_mapping and event.get('event_type')
+        )
+
+    @staticmethod
+    def _resolve_business(offer_id):
+        """Return the business_id for an offer (cached), or None if the offer doesn't exist"""
+        if not offer_id:
+            return None
+        return Analytics._resolve_businesses([offer_id]).get(offer_id)
+
+    @staticmethod
+    def _resolve_businesses(offer_ids):
+        """Map offer IDs to business IDs, querying only offers not already cached"""
+        mapping = {}
+        missing = set()
+        for offer_id in offer_ids:
+            if not offer_id or offer_id in mapping:
+                continue
+            business_id = _offer_business_cache.get(offer_id)
+            if business_id is None:
+                missing.add(offer_id)
+            elif business_id:
+                mapping[offer_id] = business_id
+        
+        if missing:
+            with get_db_connection(autocommit=True) as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT id, business_id FROM offers WHERE id = ANY(%s)", (list(missing),))
+                    found = dict(cursor.fetchall())
+            for offer_id in missing:
+                business_id = found.get(offer_id)
+                # Unknown offers are cached as 0 so they aren't looked up again
+                _offer_business_cache.set(offer_id, business_id or 0)
+                if business_id:
+                    mapping[offer_id] = business_id
+        
+        return mapping
+
     @staticmethod
     def batch_track_events_async(events_data):
         """Async wrapper for batch_track_events - fire and forget"""
-        try:
-            Analytics._executor.submit(Analytics.batch_track_events, events_data)
-        except Exception as error:
-            print(f'❌ Error submitting async batch_track_events: {error}')
-            pass
+        Analytics._enqueue('event', events_data)
 
     @staticmethod
-    def _batch_update_business_analytics(business_updates, event_date):
-        """Batch update business analytics for multiple offers"""
-        try:
-            if not business_updates:
+    def _enqueue(kind, items):
+        """Queue tracking items for the background drainer"""
+        for item in items:
+            _tracking_queue.put_nowait((kind, item))
+        Analytics._start_tracking_drainer()
+
+    @staticmethod
+    def flush_tracking_queue():
+        """Write queued tracking items in batches of up to TRACKING_FLUSH_MAX_ITEMS"""
+        while True:
+            events, refreshes = [], {}
+            taken = 0
+            while taken < TRACKING_FLUSH_MAX_ITEMS:
+                try:
+                    kind, item = _tracking_queue.get_nowait()
+                except queue.Empty:
+                    break
+                taken += 1
+                if kind == 'event':
+                    events.append(item)
+                else:
+                    business_id, event_date = item
+                    refreshes.setdefault(event_date, set()).add(business_id)
+            
+            if not taken:
                 return
-                
-            # Get business_ids for all offers in one query
-            offer_ids = list(business_updates.keys())
-            business_mapping = {}
             
-            with get_db_connection() as conn:
-                with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
-                    cursor.execute("""
-                        SELECT id, business_id FROM offers WHERE id = ANY(%s)
-                    """, (offer_ids,))
-                    results = cursor.fetchall()
-                    
-                    for row in results:
-                        business_mapping[row['id']] = row['business_id']
+            # Each of these catches and logs its own errors
+            Analytics.batch_track_events(events)
+            for event_date, business_ids in refreshes.items():
+                Analytics.refresh_active_offers(list(business_ids), event_date)
             
-            # Group updates by business_id
-            business_stats = {}
-            for offer_id, stats in business_updates.items():
-                business_id = business_mapping.get(offer_id)
-                if business_id:
-                    if business_id not in business_stats:
-                        business_stats[business_id] = {'view': 0, 'click': 0, 'conversion': 0}
-                    business_stats[business_id]['view'] += stats['view']
-                    business_stats[business_id]['click'] += stats['click']
-                    business_stats[business_id]['conversion'] += stats['conversion']
+            if taken < TRACKING_FLUSH_MAX_ITEMS:
+                return
+
+    @staticmethod
+    def _start_tracking_drainer():
+        """Start the background tracking drainer once per process"""
+        global _tracking_drainer
+        if _tracking_drainer is not None:
+            return
+        
+        with _tracking_lock:
+            if _tracking_drainer is not None:
+                return
+            _tracking_drainer = threading.Thread(target=_run_tracking_drainer, name="analytics-drainer", daemon=True)
+            _tracking_drainer.start()
+        atexit.register(Analytics.flush_tracking_queue)
+
+    @staticmethod
+    def _batch_update_business_analytics(offer_counts, business_mapping, event_date):
+        """Batch update per-offer daily counters and business analytics from (offer_id, event_type) counts"""
+        try:
+            if not offer_counts:
+                return
             
-            # Handle each business separately - check if exists, then insert or update
-            with get_db_connection() as conn:
+            # Roll offer counts up per business with one Counter per counter column
+            views, clicks, conversions = Counter(), Counter(), Counter()
+            by_type = {'view': views, 'click': clicks, 'conversion': conversions}
+            for (offer_id, event_type), count in offer_counts.items():
+                counter = by_type.get(event_type)
+                if counter is not None:
+                    counter[business_mapping[offer_id]] += count
+            # Sorted so concurrent drainers in other worker processes lock rows in the same order
+            business_ids = sorted(views.keys() | clicks.keys() | conversions.keys())
+            rows = [
+                (business_id, event_date, views[business_id], clicks[business_id], conversions[business_id])
+                for business_id in business_ids
+            ]
+            
+            with get_analytics_db_connection() as conn:
                 with conn.cursor() as cursor:
-                    for business_id, stats in business_stats.items():
-                        if stats['view'] > 0 or stats['click'] > 0 or stats['conversion'] > 0:
-                            # Check if record exists
-                            cursor.execute("""
-                                SELECT id FROM business_analytics 
-                                WHERE business_id = %s AND date = %s
-                            """, (business_id, event_date))
-                            existing_record = cursor.fetchone()
-                            
-                            if existing_record:
-                                # Update existing record
-                                cursor.execute("""
-                                    UPDATE business_analytics 
-                                    SET total_views = total_views + %s,
-                                        total_clicks = total_clicks + %s,
-                                        total_conversions = total_conversions + %s
-                                    WHERE business_id = %s AND date = %s
-                                """, (stats['view'], stats['click'], stats['conversion'], business_id, event_date))
-                            else:
-                                # Insert new record
-                                cursor.execute("""
-                                    INSERT INTO business_analytics (business_id, date, total_views, total_clicks, total_conversions, total_spent, active_offers, created_at)
-                                    VALUES (%s, %s, %s, %s, %s, 0, 0, CURRENT_TIMESTAMP)
-                                """, (business_id, event_date, stats['view'], stats['click'], stats['conversion']))
-                    
+                    psycopg2.extras.execute_values(
+                        cursor,
+                        """INSERT INTO offer_daily_stats (offer_id, date, event_type, count)
+                           VALUES %s
+                           ON CONFLICT (offer_id, date, event_type) DO UPDATE
+                           SET count = offer_daily_stats.count + EXCLUDED.count""",
+                        [(offer_id, event_date, event_type, count) for (offer_id, event_type), count in sorted(offer_counts.items(), key=lambda item: (item[0][0], str(item[0][1])))],
+                        page_size=1000
+                    )
+                    if rows:
+                        # Single UPSERT for all businesses - relies on the (business_id, date) unique index
+                        psycopg2.extras.execute_values(
+                            cursor,
+                            """INSERT INTO business_analytics (business_id, date, total_views, total_clicks, total_conversions, total_spent, active_offers, created_at)
+                               VALUES %s
+                               ON CONFLICT (business_id, date) DO UPDATE
+                               SET total_views = business_analytics.total_views + EXCLUDED.total_views,
+                                   total_clicks = business_analytics.total_clicks + EXCLUDED.total_clicks,
+                                   total_conversions = business_analytics.total_conversions + EXCLUDED.total_conversions""",
+                            rows,
+                            template="(%s, %s, %s, %s, %s, 0, 0, CURRENT_TIMESTAMP)",
+                            page_size=500
+                        )
+                        Analytics._update_active_offers(cursor, business_ids, event_date)
                     conn.commit()
                     
         except Exception as error:
@@ -193,97 +550,127 @@ class Analytics:
             pass
 
     @staticmethod
-    def track_event(event_type, session_id, user_id=None, offer_id=None, metadata=None, ip_address=None, user_agent=None):
-        """Track analytics events"""
+    def _update_active_offers(cursor, business_ids, event_date):
+        """Recompute active_offers for the given businesses with one set-based UPDATE"""
+        cursor.execute("""
+            UPDATE business_analytics ba
+            SET active_offers = c.cnt
+            FROM (
+                SELECT business_id, COUNT(*) AS cnt
+                FROM offers
+                WHERE business_id = ANY(%s)
+                AND status = 'approved'
+                AND (expires_at IS NULL OR expires_at > CURRENT_TIMESTAMP)
+                GROUP BY business_id
+            ) c
+            WHERE ba.business_id = c.business_id AND ba.date = %s
+        """, (business_ids, event_date))
+        for business_id in business_ids:
+            _active_offers_refreshed.set((business_id, event_date), True)
+
+    @staticmethod
+    def refresh_active_offers(business_ids, event_date):
+        """Recompute active_offers for the given businesses on event_date"""
         try:
-            event_date = date.today()
-            
-            # Insert into analytics_events table
-            with get_db_connection() as conn:
+            with get_analytics_db_connection() as conn:
                 with conn.cursor() as cursor:
-                    cursor.execute("""
-                        INSERT INTO analytics_events (event_type, session_id, user_id, offer_id, metadata, ip_address, user_agent, created_at)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
-                    """, (event_type, session_id, user_id, offer_id, json.dumps(metadata) if metadata else None, ip_address, user_agent))
+                    Analytics._update_active_offers(cursor, business_ids, event_date)
                     conn.commit()
-            
-            # Push to business analytics if offer_id is provided
-            if offer_id:
-                Analytics._push_to_business_analytics(event_type, offer_id, event_date)
-                
         except Exception as error:
-            # Don't raise the error to avoid breaking the main application flow
-            pass
+            print(f'❌ Error refreshing active offers: {error}')
+
+    @staticmethod
+    def _schedule_active_offers_refresh(business_ids, event_date):
+        """Refresh active_offers in the background for businesses not refreshed recently"""
+        stale = [business_id for business_id in business_ids if _active_offers_refreshed.get((business_id, event_date)) is None]
+        if not stale:
+            return
+        for business_id in stale:
+            _active_offers_refreshed.set((business_id, event_date), True)
+        Analytics._enqueue('refresh', [(business_id, event_date) for business_id in stale])
 
     @staticmethod
-    def _push_to_business_analytics(event_type, offer_id, event_date):
-        """Push analytics data to business_analytics table for business dashboard"""
+    def track_event(event_type, session_id, user_id=None, offer_id=None, metadata=None, ip_address=None, user_agent=None):
+        """Track analytics events
+        
+        The event insert, the session summary upsert and the business_analytics
+        counter upsert run as one statement, so tracking costs a single round-trip.
+        Views are high-volume, so they are queued for the batched writer instead;
+        they still land in analytics_events for the location and city reports.
+        """
+        if event_type == 'view':
+            Analytics.batch_track_events_async([{
+                'event_type': event_type,
+                'session_id': session_id,
+                'user_id': user_id,
+                'offer_id': offer_id,
+                'metadata': metadata,
+                'ip_address': ip_address,
+                'user_agent': user_agent
+            }])
+            return
+        
         try:
-            # First, get the business_id for this offer
-            with get_db_connection() as conn:
-                with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
-                    cursor.execute("SELECT business_id FROM offers WHERE id = %s", (offer_id,))
-                    offer_result = cursor.fetchone()
-                    
-                    if not offer_result:
-                        return
-                    
-                    business_id = offer_result['business_id']
-            
-            # Check if record exists for this business and date
-            with get_db_connection() as conn:
-                with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
-                    cursor.execute("""
-                        SELECT id FROM business_analytics 
-                        WHERE business_id = %s AND date = %s
-                    """, (business_id, event_date))
-                    existing_record = cursor.fetchone()
-                    
-                    if not existing_record:
-                        # Create new record
-                        cursor.execute("""
-                            INSERT INTO business_analytics (business_id, date, total_views, total_clicks, total_conversions, total_spent, active_offers, created_at) 
-                            VALUES (%s, %s, 0, 0, 0, 0, 0, CURRENT_TIMESTAMP)
-                        """, (business_id, event_date))
-                        conn.commit()
-            
-            # Update the appropriate counter based on event type
-            field_mapping = {
-                'view': 'total_views',
-                'click': 'total_clicks', 
-                'conversion': 'total_conversions'
-            }
-            
-            field = field_mapping.get(event_type)
-            if not field:
-                return
+            event_date = date.today()
+            Analytics.ensure_event_partitions()
+            business_id = Analytics._resolve_business(offer_id)
+            city = metadata.get('city') if isinstance(metadata, dict) else None
             
-            # Update the business analytics counter
-            with get_db_connection() as conn:
+            with get_analytics_db_connection() as conn:
                 with conn.cursor() as cursor:
-                    cursor.execute(f"""
-                        UPDATE business_analytics 
-                        SET {field} = {field} + 1
-                        WHERE business_id = %s AND date = %s
-                    """, (business_id, event_date))
-                    
-                    # Also update active_offers count for this business
-                    cursor.execute("""
-                        UPDATE business_analytics 
-                        SET active_offers = (
-                            SELECT COUNT(*) 
-                            FROM offers 
-                            WHERE business_id = %s 
-                            AND status = 'approved' 
-                            AND (expires_at IS NULL OR expires_at > CURRENT_TIMESTAMP)
+                    # Hot path - PREPAREd once per pooled connection
+                    execute_prepared(cursor, 'analytics_track_event', """
+                        WITH ev AS (
+                            INSERT INTO analytics_events (event_type, session_id, user_id, offer_id, business_id, metadata, ip_address, user_agent, created_at)
+                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
+                        ),
+                        sess AS (
+                            INSERT INTO analytics_sessions (session_id, city, user_id, first_seen, last_seen, event_count, duration_seconds)
+                            SELECT %s::varchar, %s::varchar, %s::int, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, 1, 0
+                            WHERE %s::varchar IS NOT NULL
+                            ON CONFLICT (session_id) DO UPDATE
+                            SET city = COALESCE(analytics_sessions.city, EXCLUDED.city),
+                                user_id = COALESCE(analytics_sessions.user_id, EXCLUDED.user_id),
+                                first_seen = LEAST(analytics_sessions.first_seen, EXCLUDED.first_seen),
+                                last_seen = GREATEST(analytics_sessions.last_seen, EXCLUDED.last_seen),
+                                event_count = analytics_sessions.event_count + EXCLUDED.event_count,
+                                duration_seconds = EXTRACT(EPOCH FROM (
+                                    GREATEST(analytics_sessions.last_seen, EXCLUDED.last_seen)
+                                    - LEAST(analytics_sessions.first_seen, EXCLUDED.first_seen)
+                                ))
+                        ),
+                        offer_day AS (
+                            INSERT INTO offer_daily_stats (offer_id, date, event_type, count)
+                            SELECT %s::int, %s::date, %s::varchar, 1
+                            WHERE %s::int IS NOT NULL
+                            ON CONFLICT (offer_id, date, event_type) DO UPDATE
+                            SET count = offer_daily_stats.count + 1
                         )
-                        WHERE business_id = %s AND date = %s
-                    """, (business_id, business_id, event_date))
-                    
+                        INSERT INTO business_analytics (business_id, date, total_views, total_clicks, total_conversions, total_spent, active_offers, created_at)
+                        SELECT %s::int, %s::date,
+                               CASE WHEN %s::text = 'view' THEN 1 ELSE 0 END,
+                               CASE WHEN %s::text = 'click' THEN 1 ELSE 0 END,
+                               CASE WHEN %s::text = 'conversion' THEN 1 ELSE 0 END,
+                               0, 0, CURRENT_TIMESTAMP
+                        WHERE %s::int IS NOT NULL
+                        ON CONFLICT (business_id, date) DO UPDATE
+                        SET total_views = business_analytics.total_views + EXCLUDED.total_views,
+                            total_clicks = business_analytics.total_clicks + EXCLUDED.total_clicks,
+                            total_conversions = business_analytics.total_conversions + EXCLUDED.total_conversions
+                    """, (
+                        event_type, session_id, user_id, offer_id, business_id,
+                        _OrjsonJson(metadata) if metadata else None, ip_address, user_agent,
+                        session_id, city, user_id, session_id,
+                        offer_id, event_date, event_type, business_id,
+                        business_id, event_date, event_type, event_type, event_type, business_id
+                    ))
                     conn.commit()
-                    
+            
+            if business_id:
+                Analytics._schedule_active_offers_refresh([business_id], event_date)
+                
         except Exception as error:
-            # Don't raise the error to avoid breaking the main tracking function
+            # Don't raise the error to avoid breaking the main application flow
             pass
 
     @staticmethod
@@ -294,35 +681,9 @@ class Analytics:
             
         try:
             # First, get the business_id for this offer
-            with get_db_connection() as conn:
-                with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
-                    cursor.execute("SELECT business_id FROM offers WHERE id = %s", (offer_id,))
-                    offer_result = cursor.fetchone()
-                    
-                    if not offer_result:
-                        return
-                    
-                    business_id = offer_result['business_id']
-            
-            # Check if record exists for this business and date, create if not
-            with get_db_connection() as conn:
-                with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
-                    cursor.execute("""
-                        SELECT id FROM business_analytics 
-                        WHERE business_id = %s AND date = %s
-                    """, (business_id, event_date))
-                    existing_record = cursor.fetchone()
-                    
-                    if not existing_record:
-                        # Create new record with default values
-                        cursor.execute("""
-                            INSERT INTO business_analytics 
-                            (business_id, date, total_views, total_clicks, total_conversions, 
-                             total_spent, active_offers, conversion_calls, conversion_directions, 
-                             conversion_website, created_at) 
-                            VALUES (%s, %s, 0, 0, 0, 0, 0, 0, 0, 0, CURRENT_TIMESTAMP)
-                        """, (business_id, event_date))
-                        conn.commit()
+            business_id = Analytics._resolve_business(offer_id)
+            if not business_id:
+                return
             
             # Map conversion types to database fields
             conversion_field_mapping = {
@@ -335,94 +696,215 @@ class Analytics:
             if not field:
                 return
             
-            # Update the specific conversion counter and total conversions
-            with get_db_connection() as conn:
+            # Create today's row or bump the conversion counters in one round trip
+            website, calls, directions = (int(column == field) for column in conversion_field_mapping.values())
+            with get_analytics_db_connection() as conn:
                 with conn.cursor() as cursor:
-                    cursor.execute(f"""
-                        UPDATE business_analytics 
-                        SET {field} = {field} + 1,
-                            total_conversions = total_conversions + 1
-                        WHERE business_id = %s AND date = %s
+                    execute_prepared(cursor, f'analytics_business_{field}', f"""
+                        INSERT INTO business_analytics 
+                        (business_id, date, total_views, total_clicks, total_conversions, 
+                         total_spent, active_offers, conversion_website, conversion_calls, 
+                         conversion_directions, created_at) 
+                        VALUES (%s, %s, 0, 0, 1, 0, 0, {website}, {calls}, {directions}, CURRENT_TIMESTAMP)
+                        ON CONFLICT (business_id, date) DO UPDATE SET
+                            {field} = business_analytics.{field} + 1,
+                            total_conversions = business_analytics.total_conversions + 1
                     """, (business_id, event_date))
-                    
-                    # Also update active_offers count for this business
-                    cursor.execute("""
-                        UPDATE business_analytics 
-                        SET active_offers = (
-                            SELECT COUNT(*) 
-                            FROM offers 
-                            WHERE business_id = %s 
-                            AND status = 'approved' 
-                            AND (expires_at IS NULL OR expires_at > CURRENT_TIMESTAMP)
-                        )
-                        WHERE business_id = %s AND date = %s
-                    """, (business_id, business_id, event_date))
-                    
                     conn.commit()
+            
+            Analytics._schedule_active_offers_refresh([business_id], event_date)
                     
         except Exception as error:
             pass
 
     @staticmethod
-    def get_dashboard_data(start_date, end_date):
-        """Get dashboard analytics data for date range"""
+    def rollup_daily_stats(force=False):
+        """Aggregate closed days into analytics_daily_stats
+        
+        Called from the tracking drainer; runs at most every
+        DAILY_ROLLUP_CHECK_INTERVAL seconds per process unless forced. Only one
+        worker rolls up at a time, the others skip the round.
+        """
+        global _rollup_checked_at
+        now = time.monotonic()
+        if not force and _rollup_checked_at is not None and now - _rollup_checked_at < DAILY_ROLLUP_CHECK_INTERVAL:
+            return
+        _rollup_checked_at = now
+        
         try:
-            # Get daily stats for the period
             with get_db_connection() as conn:
-                with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
-                    cursor.execute("""
-                        SELECT 
-                            date,
-                            total_views,
-                            total_clicks,
-                            total_conversions,
-                            unique_users,
-                            top_categories,
-                            top_merchants
-                        FROM analytics_daily_stats 
-                        WHERE date BETWEEN %s AND %s 
-                        ORDER BY date
-                    """, (start_date, end_date))
-                    daily_stats = [dict(row) for row in cursor.fetchall()]
-            
-            # Get event summary for the period
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT pg_try_advisory_xact_lock(hashtext('analytics_daily_rollup'))")
+                    if cursor.fetchone()[0]:
+                        Analytics._rollup_daily_stats(cursor)
+                    conn.commit()
+        except Exception as error:
+            print(f'❌ Error rolling up daily analytics: {error}')
+
+    @staticmethod
+    def _rollup_daily_stats(cursor):
+        """Roll up closed days on the given cursor
+        
+        A day counts as closed DAILY_ROLLUP_GRACE after midnight. Every closed day
+        without a roll-up row is read from analytics_events once, so the rolled-up
+        days are contiguous and the dashboard reads later days from raw events.
+        """
+        cursor.execute("""
+            WITH days AS (
+                SELECT d::date AS date
+                FROM generate_series(
+                    (SELECT MIN(created_at)::date FROM analytics_events),
+                    (LOCALTIMESTAMP - %s::interval)::date - 1,
+                    INTERVAL '1 day'
+                ) d
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM analytics_daily_stats s
+                    WHERE s.date = d::date AND s.event_type_counts IS NOT NULL
+                )
+            ),
+            agg AS (
+                SELECT
+                    days.date,
+                    ae.event_type,
+                    GROUPING(ae.event_type) AS is_total,
+                    COUNT(ae.id) AS count,
+                    COUNT(DISTINCT ae.session_id) AS unique_sessions,
+                    COUNT(DISTINCT ae.user_id) AS unique_users
+                FROM days
+                LEFT JOIN analytics_events ae
+                    ON ae.created_at >= days.date AND ae.created_at < days.date + INTERVAL '1 day'
+                GROUP BY GROUPING SETS ((days.date, ae.event_type), (days.date))
+            )
+            INSERT INTO analytics_daily_stats
+                (date, total_views, total_clicks, total_conversions, unique_users, event_type_counts, updated_at)
+            SELECT
+                date,
+                COALESCE(SUM(count) FILTER (WHERE is_total = 0 AND event_type = 'view'), 0),
+                COALESCE(SUM(count) FILTER (WHERE is_total = 0 AND event_type = 'click'), 0),
+                COALESCE(SUM(count) FILTER (WHERE is_total = 0 AND event_type = 'conversion'), 0),
+                COALESCE(MAX(unique_users) FILTER (WHERE is_total = 1), 0),
+                COALESCE(
+                    jsonb_object_agg(event_type, jsonb_build_object(
+                        'count', count,
+                        'unique_sessions', unique_sessions,
+                        'unique_users', unique_users
+                    )) FILTER (WHERE is_total = 0 AND event_type IS NOT NULL),
+                    '{}'::jsonb
+                ),
+                CURRENT_TIMESTAMP
+            FROM agg
+            GROUP BY date
+            ON CONFLICT (date) DO UPDATE
+            SET total_views = EXCLUDED.total_views,
+                total_clicks = EXCLUDED.total_clicks,
+                total_conversions = EXCLUDED.total_conversions,
+                unique_users = EXCLUDED.unique_users,
+                event_type_counts = EXCLUDED.event_type_counts,
+                updated_at = EXCLUDED.updated_at
+        """, (DAILY_ROLLUP_GRACE,))
+
+    @staticmethod
+    def get_dashboard_data(start_date, end_date):
+        """Get dashboard analytics data for date range
+        
+        Read-only. Closed days come from the analytics_daily_stats roll-up
+        (written by rollup_daily_stats); days after the last rolled-up day are
+        aggregated from analytics_events. Top offers come from the
+        offer_daily_stats counters. Unique session/user counts in the event
+        summary are summed per day.
+        """
+        try:
+            # All dashboard sections are built in a single statement
             with get_db_connection() as conn:
-                with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                with conn.cursor() as cursor:
                     cursor.execute("""
-                        SELECT 
-                            event_type,
-                            COUNT(*) as count,
-                            COUNT(DISTINCT session_id) as unique_sessions,
-                            COUNT(DISTINCT user_id) as unique_users
-                        FROM analytics_events 
-                        WHERE DATE(created_at) BETWEEN %s AND %s 
-                        GROUP BY event_type
-                    """, (start_date, end_date))
-                    event_summary = [dict(row) for row in cursor.fetchall()]
+                        WITH daily AS (
+                            SELECT 
+                                date,
+                                total_views,
+                                total_clicks,
+                                total_conversions,
+                                unique_users,
+                                top_categories,
+                                top_merchants,
+                                event_type_counts
+                            FROM analytics_daily_stats 
+                            WHERE date BETWEEN %(start)s::date AND %(end)s::date
+                        ),
+                        rolled_up AS (
+                            SELECT
+                                e.key AS event_type,
+                                (e.value->>'count')::int AS count,
+                                (e.value->>'unique_sessions')::int AS unique_sessions,
+                                (e.value->>'unique_users')::int AS unique_users
+                            FROM daily, jsonb_each(daily.event_type_counts) e
+                        ),
+                        recent AS (
+                            -- Today (and yesterday during the roll-up grace period)
+                            -- is not rolled up yet - read it from the raw events
+                            SELECT 
+                                event_type,
+                                COUNT(*)::int as count,
+                                COUNT(DISTINCT session_id)::int as unique_sessions,
+                                COUNT(DISTINCT user_id)::int as unique_users
+                            FROM analytics_events 
+                            WHERE created_at >= GREATEST(%(start)s::date, (
+                                SELECT MAX(date) + 1 FROM analytics_daily_stats
+                                WHERE event_type_counts IS NOT NULL
+                            ))
+                            AND created_at < %(end)s::date + INTERVAL '1 day'
+                            GROUP BY event_type
+                        ),
+                        events AS (
+                            SELECT
+                                event_type,
+                                SUM(count)::int AS count,
+                                SUM(unique_sessions)::int AS unique_sessions,
+                                SUM(unique_users)::int AS unique_users
+                            FROM (SELECT * FROM rolled_up UNION ALL SELECT * FROM recent) e
+                            GROUP BY event_type
+                        ),
+                        top_offers AS (
+                            SELECT 
+                                o.title,
+                                o.category,
+                                SUM(s.count) as event_count,
+                                s.event_type
+                            FROM offer_daily_stats s
+                            JOIN offers o ON s.offer_id = o.id
+                            WHERE s.date BETWEEN %(start)s::date AND %(end)s::date
+                            AND s.event_type IN ('view', 'click')
+                            GROUP BY o.id, o.title, o.category, s.event_type
+                            ORDER BY event_count DESC
+                            LIMIT 10
+                        )
+                        SELECT json_build_object(
+                            'daily', COALESCE((
+                                SELECT json_agg(d ORDER BY d.date)
+                                FROM (
+                                    SELECT date, total_views, total_clicks, total_conversions,
+                                           unique_users, top_categories, top_merchants
+                                    FROM daily
+                                ) d
+                            ), '[]'::json),
+                            'events', COALESCE((SELECT json_agg(events) FROM events), '[]'::json),
+                            'top', COALESCE((SELECT json_agg(t ORDER BY t.event_count DESC) FROM top_offers t), '[]'::json)
+                        )
+                    """, {'start': start_date, 'end': end_date})
+                    result = cursor.fetchone()[0]
             
-            # Get top offers by views/clicks
-            with get_db_connection() as conn:
-                with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
-                    cursor.execute("""
-                        SELECT 
-                            o.title,
-                            o.category,
-                            COUNT(*) as event_count,
-                            ae.event_type
-                        FROM analytics_events ae
-                        JOIN offers o ON ae.offer_id = o.id
-                        WHERE DATE(ae.created_at) BETWEEN %s AND %s 
-                        AND ae.event_type IN ('view', 'click')
-                        GROUP BY o.id, o.title, o.category, ae.event_type
-                        ORDER BY event_count DESC
-                        LIMIT 10
-                    """, (start_date, end_date))
-                    top_offers = [dict(row) for row in cursor.fetchall()]
-            
-            # Calculate totals
-            total_views = sum(stat['total_views'] or 0 for stat in daily_stats)
-            total_clicks = sum(stat['total_clicks'] or 0 for stat in daily_stats)
-            total_conversions = sum(stat['total_conversions'] or 0 for stat in daily_stats)
+            daily_stats = result['daily']
+            for stat in daily_stats:
+                # Keep returning date objects, as before the JSON aggregation
+                stat['date'] = date.fromisoformat(stat['date'])
+            event_summary = result['events']
+            top_offers = result['top']
+            
+            # Calculate totals (including today's events)
+            counts = {event['event_type']: event['count'] for event in event_summary}
+            total_views = counts.get('view', 0)
+            total_clicks = counts.get('click', 0)
+            total_conversions = counts.get('conversion', 0)
             
             # Calculate conversion rate
             conversion_rate = (total_conversions / total_views * 100) if total_views > 0 else 0
@@ -457,7 +939,8 @@ class Analytics:
             params = [offer_id]
             
             if start_date and end_date:
-                where_clause += " AND DATE(created_at) BETWEEN %s AND %s"
+                # Half-open timestamp range so the created_at index can be used
+                where_clause += " AND created_at >= %s AND created_at < %s::date + INTERVAL '1 day'"
                 params.extend([start_date, end_date])
             
             with get_db_connection() as conn:
@@ -486,11 +969,12 @@ class Analytics:
     def get_user_analytics(user_id, start_date=None, end_date=None):
         """Get analytics for a specific user"""
         try:
-            where_clause = "WHERE user_id = %s"
+            where_clause = "WHERE ae.user_id = %s"
             params = [user_id]
             
             if start_date and end_date:
-                where_clause += " AND DATE(created_at) BETWEEN %s AND %s"
+                # Half-open timestamp range so the created_at index can be used
+                where_clause += " AND ae.created_at >= %s AND ae.created_at < %s::date + INTERVAL '1 day'"
                 params.extend([start_date, end_date])
             
             with get_db_connection() as conn:
@@ -524,13 +1008,13 @@ class Analytics:
             params = []
             
             if start_date and end_date:
-                date_filter = "WHERE ae.created_at BETWEEN %s AND %s"
+                date_filter = "AND ae.created_at >= %s AND ae.created_at < %s::date + INTERVAL '1 day'"
                 params = [start_date, end_date]
             
             query = f"""
             SELECT 
-                ae.metadata->>'userLocation'->>'lat' as latitude,
-                ae.metadata->>'userLocation'->>'lng' as longitude,
+                ae.metadata->'userLocation'->>'lat' as latitude,
+                ae.metadata->'userLocation'->>'lng' as longitude,
                 COALESCE(ae.metadata->>'city', 'Unknown') as city,
                 COUNT(CASE WHEN ae.event_type = 'view' THEN 1 END) as total_views,
                 COUNT(CASE WHEN ae.event_type = 'click' THEN 1 END) as total_clicks,
@@ -538,11 +1022,11 @@ class Analytics:
                 COUNT(DISTINCT ae.session_id) as unique_sessions,
                 COUNT(DISTINCT ae.user_id) as unique_users
             FROM analytics_events ae
+            WHERE ae.metadata->'userLocation' IS NOT NULL
             {date_filter}
-            AND ae.metadata->>'userLocation' IS NOT NULL
             GROUP BY 
-                ae.metadata->>'userLocation'->>'lat',
-                ae.metadata->>'userLocation'->>'lng',
+                ae.metadata->'userLocation'->>'lat',
+                ae.metadata->'userLocation'->>'lng',
                 ae.metadata->>'city'
             ORDER BY total_views DESC
             LIMIT 50
@@ -567,13 +1051,13 @@ class Analytics:
             params = [offer_id]
             
             if start_date and end_date:
-                date_filter = "AND ae.created_at BETWEEN %s AND %s"
+                date_filter = "AND ae.created_at >= %s AND ae.created_at < %s::date + INTERVAL '1 day'"
                 params.extend([start_date, end_date])
             
             query = f"""
             SELECT 
-                ae.metadata->>'userLocation'->>'lat' as latitude,
-                ae.metadata->>'userLocation'->>'lng' as longitude,
+                ae.metadata->'userLocation'->>'lat' as latitude,
+                ae.metadata->'userLocation'->>'lng' as longitude,
                 COALESCE(ae.metadata->>'city', 'Unknown') as city,
                 ae.metadata->>'action' as action_type,
                 COUNT(*) as event_count,
@@ -584,10 +1068,10 @@ class Analytics:
             FROM analytics_events ae
             WHERE ae.offer_id = %s
             {date_filter}
-            AND ae.metadata->>'userLocation' IS NOT NULL
+            AND ae.metadata->'userLocation' IS NOT NULL
             GROUP BY 
-                ae.metadata->>'userLocation'->>'lat',
-                ae.metadata->>'userLocation'->>'lng',
+                ae.metadata->'userLocation'->>'lat',
+                ae.metadata->'userLocation'->>'lng',
                 ae.metadata->>'city',
                 ae.metadata->>'action'
             ORDER BY event_count DESC
@@ -606,33 +1090,50 @@ class Analytics:
 
     @staticmethod
     def get_city_performance_analytics(start_date=None, end_date=None):
-        """Get analytics performance by city for business insights"""
+        """Get analytics performance by city for business insights
+        
+        Session durations come from the analytics_sessions summary instead of a
+        window function over raw events.
+        """
         try:
             date_filter = ""
+            session_filter = ""
             params = []
             
             if start_date and end_date:
-                date_filter = "WHERE ae.created_at BETWEEN %s AND %s"
-                params = [start_date, end_date]
+                date_filter = "WHERE ae.created_at >= %s AND ae.created_at < %s::date + INTERVAL '1 day'"
+                session_filter = "WHERE s.last_seen >= %s AND s.first_seen < %s::date + INTERVAL '1 day'"
+                params = [start_date, end_date, start_date, end_date]
             
             query = f"""
+            WITH city_events AS (
+                SELECT 
+                    COALESCE(ae.metadata->>'city', 'Unknown') as city,
+                    COUNT(CASE WHEN ae.event_type = 'view' THEN 1 END) as total_views,
+                    COUNT(CASE WHEN ae.event_type = 'click' THEN 1 END) as total_clicks,
+                    COUNT(CASE WHEN ae.event_type = 'conversion' THEN 1 END) as total_conversions,
+                    COUNT(DISTINCT ae.session_id) as unique_sessions,
+                    COUNT(DISTINCT ae.user_id) as unique_users,
+                    COUNT(DISTINCT ae.offer_id) as unique_offers_viewed
+                FROM analytics_events ae
+                {date_filter}
+                GROUP BY ae.metadata->>'city'
+            ),
+            city_sessions AS (
+                SELECT 
+                    COALESCE(s.city, 'Unknown') as city,
+                    AVG(s.duration_seconds) as avg_session_duration
+                FROM analytics_sessions s
+                {session_filter}
+                GROUP BY COALESCE(s.city, 'Unknown')
+            )
             SELECT 
-                COALESCE(ae.metadata->>'city', 'Unknown') as city,
-                COUNT(CASE WHEN ae.event_type = 'view' THEN 1 END) as total_views,
-                COUNT(CASE WHEN ae.event_type = 'click' THEN 1 END) as total_clicks,
-                COUNT(CASE WHEN ae.event_type = 'conversion' THEN 1 END) as total_conversions,
-                COUNT(DISTINCT ae.session_id) as unique_sessions,
-                COUNT(DISTINCT ae.user_id) as unique_users,
-                COUNT(DISTINCT ae.offer_id) as unique_offers_viewed,
-                ROUND(
-                    COUNT(CASE WHEN ae.event_type = 'conversion' THEN 1 END)::numeric / 
-                    NULLIF(COUNT(CASE WHEN ae.event_type = 'view' THEN 1 END), 0) * 100, 2
-                ) as conversion_rate,
-                AVG(EXTRACT(EPOCH FROM (ae.created_at - LAG(ae.created_at) OVER (PARTITION BY ae.session_id ORDER BY ae.created_at)))) as avg_session_duration
-            FROM analytics_events ae
-            {date_filter}
-            GROUP BY ae.metadata->>'city'
-            ORDER BY total_views DESC
+                e.*,
+                ROUND(e.total_conversions::numeric / NULLIF(e.total_views, 0) * 100, 2) as conversion_rate,
+                cs.avg_session_duration
+            FROM city_events e
+            LEFT JOIN city_sessions cs ON cs.city = e.city
+            ORDER BY e.total_views DESC
             """
             
             with get_db_connection() as conn:
@@ -644,4 +1145,11 @@ class Analytics:
             
         except Exception as error:
             print(f'❌ Error getting city performance analytics: {error}')
-            raise error 
\ No newline at end of file
+            raise error 
+
+def _run_tracking_drainer():
+    """Background loop flushing queued analytics tracking and rolling up closed days"""
+    while True:
+        time.sleep(TRACKING_FLUSH_INTERVAL)
+        Analytics.flush_tracking_queue()
+        Analytics.rollup_daily_stats()
@@ -1,8 +1,18 @@
+import csv
+import io
 import uuid
 from datetime import datetime
 from config.database import get_db_connection
+from utils.cache import TTLCache
+import orjson
 import psycopg2.extras
 
+# Seeds at least this large are loaded with COPY instead of INSERT
+CATEGORY_COPY_THRESHOLD = 1000
+
+# Categories are a small reference table - cache the list and single lookups for 5 minutes
+_categories_cache = TTLCache(maxsize=256, ttl=300)
+
 class Category:
     def __init__(self, category_data):
         self.id = category_data.get('id')
@@ -62,10 +72,14 @@ class Category:
     @staticmethod
     def get_all_categories():
         """Get all categories from the existing simple table structure"""
+        cached = _categories_cache.get('all')
+        if cached is not None:
+            return list(cached)
+        
         try:
             query = "SELECT * FROM categories ORDER BY name"
             
-            with get_db_connection() as conn:
+            with get_db_connection(autocommit=True) as conn:
                 with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
                     cursor.execute(query)
                     results = cursor.fetchall()
@@ -81,19 +95,35 @@ class Category:
                 }
                 categories.append(Category(category_data).to_dict())
             
-            return categories
+            _categories_cache.set('all', categories)
+            return list(categories)
             
         except Exception as error:
             print(f'❌ Error getting categories: {error}')
             raise error
 
+    @staticmethod
+    def get_all_categories_json():
+        """get_all_categories() serialized with orjson, cached so the endpoint skips encoding"""
+        cached = _categories_cache.get('all_json')
+        if cached is not None:
+            return cached
+        
+        body = orjson.dumps(Category.get_all_categories(), option=orjson.OPT_SORT_KEYS)
+        _categories_cache.set('all_json', body)
+        return body
+
     @staticmethod
     def get_category_by_id(category_id):
         """Get category by ID"""
+        cached = _categories_cache.get(('id', category_id))
+        if cached is not None:
+            return cached
+        
         try:
             query = "SELECT * FROM categories WHERE id = %s"
             
-            with get_db_connection() as conn:
+            with get_db_connection(autocommit=True) as conn:
                 with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
                     cursor.execute(query, (category_id,))
                     result = cursor.fetchone()
@@ -106,7 +136,9 @@ class Category:
                     'name_en': result['name'],
                     'is_active': True
                 }
-                return Category(category_data).to_dict()
+                category = Category(category_data).to_dict()
+                _categories_cache.set(('id', category_id), category)
+                return category
             return None
             
         except Exception as error:
@@ -137,6 +169,7 @@ class Category:
                     result = cursor.fetchone()
                     conn.commit()
             
+            _categories_cache.clear()
             return Category(dict(result)).to_dict()
             
         except Exception as error:
@@ -219,16 +252,52 @@ class Category:
             }
         ]
         
+        rows = [
+            (c['name'], c['name_fi'], c['name_en'], c['description'], c['icon'])
+            for c in default_categories
+        ]
+        
         try:
-            for category_data in default_categories:
-                # Check if category already exists
-                with get_db_connection() as conn:
-                    with conn.cursor() as cursor:
-                        cursor.execute("SELECT COUNT(*) FROM categories WHERE name = %s", (category_data['name'],))
-                        if cursor.fetchone()[0] == 0:
-                            Category.create_category(category_data)
-            
+            Category.seed_categories(rows)
             print('✅ Default categories added successfully')
         except Exception as error:
             print(f'❌ Error adding default categories: {error}')
+            raise error
+
+    @staticmethod
+    def seed_categories(rows):
+        """Insert (name, name_fi, name_en, description, icon) rows, skipping names that exist
+        
+        Large seeds are streamed with COPY into a staging table first.
+        """
+        try:
+            with get_db_connection() as conn:
+                with conn.cursor() as cursor:
+                    if len(rows) >= CATEGORY_COPY_THRESHOLD:
+                        cursor.execute("""
+                            CREATE TEMP TABLE categories_seed 
+                            (name VARCHAR(100), name_fi VARCHAR(100), name_en VARCHAR(100), description TEXT, icon VARCHAR(50))
+                            ON COMMIT DROP
+                        """)
+                        buffer = io.StringIO()
+                        csv.writer(buffer).writerows(rows)
+                        buffer.seek(0)
+                        cursor.copy_expert("COPY categories_seed FROM STDIN WITH CSV", buffer)
+                        cursor.execute("""
+                            INSERT INTO categories (name, name_fi, name_en, description, icon)
+                            SELECT name, name_fi, name_en, description, icon FROM categories_seed
+                            ON CONFLICT (name) DO NOTHING
+                        """)
+                    else:
+                        # One statement for all rows; the UNIQUE name constraint skips existing ones
+                        psycopg2.extras.execute_values(cursor, """
+                            INSERT INTO categories (name, name_fi, name_en, description, icon)
+                            VALUES %s
+                            ON CONFLICT (name) DO NOTHING
+                        """, rows)
+                    conn.commit()
+            
+            _categories_cache.clear()
+        except Exception as error:
+            print(f'❌ Error seeding categories: {error}')
             raise error 
\ No newline at end of file
@@ -1,194 +1,439 @@
 #!/usr/bin/env python3
 
+import atexit
+import logging
+import queue
+import threading
+import time
 import psycopg2
 import psycopg2.extras
 from datetime import date
-from config.database import get_db_connection
+from config.database import get_db_connection, execute_prepared
+from utils.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Counter columns of offer_analytics, in table order
+COUNTER_FIELDS = ('views', 'clicks', 'conversions',
+                  'conversion_calls', 'conversion_directions', 'conversion_website')
+
+# The batch writer's statements are built once here; their text never changes,
+# so each is PREPAREd once per pooled connection
+
+# Missing (offer, date) rows are created first, in key order, so the batch can
+# lock and read every row before changing it
+_BATCH_CREATE_ROWS_SQL = f"""
+    INSERT INTO offer_analytics (offer_id, date, {', '.join(COUNTER_FIELDS)}, created_at)
+    SELECT t.offer_id, t.date, {', '.join(['0'] * len(COUNTER_FIELDS))}, CURRENT_TIMESTAMP
+    FROM UNNEST(%s::int[], %s::date[]) AS t(offer_id, date)
+    ORDER BY t.offer_id, t.date
+    ON CONFLICT (offer_id, date) DO NOTHING
+"""
+
+_BATCH_ROWS_SQL = f"""
+    SELECT offer_id, date, user_id, user_city, {', '.join(COUNTER_FIELDS)}
+    FROM offer_analytics 
+    WHERE (offer_id, date) IN (
+        SELECT * FROM UNNEST(%s::int[], %s::date[])
+    )
+    ORDER BY offer_id, date
+    FOR UPDATE
+"""
+
+_BATCH_UPDATE_SQL = f"""
+    UPDATE offer_analytics o SET
+        {', '.join(f"{column} = o.{column} + t.{column}" for column in COUNTER_FIELDS)},
+        user_id = COALESCE(o.user_id, t.user_id::int),
+        user_city = COALESCE(o.user_city, t.user_city)
+    -- user ids travel as text[]: an all-NULL array is text[] and would not coerce to int[]
+    FROM UNNEST(
+        %s::int[], %s::date[],
+        {', '.join(['%s::int[]'] * len(COUNTER_FIELDS))},
+        %s::text[], %s::text[]
+    ) AS t(offer_id, date, {', '.join(COUNTER_FIELDS)}, user_id, user_city)
+    WHERE o.offer_id = t.offer_id AND o.date = t.date
+"""
+
+# Per-(city, day) counter changes of a batch; may be negative when a row moves to a city
+_CITY_ROLLUP_SQL = f"""
+    INSERT INTO city_analytics_daily (user_city, date, {', '.join(COUNTER_FIELDS)})
+    SELECT * FROM UNNEST(
+        %s::text[], %s::date[],
+        {', '.join(['%s::bigint[]'] * len(COUNTER_FIELDS))}
+    )
+    ON CONFLICT (user_city, date) DO UPDATE SET
+        {', '.join(f"{column} = city_analytics_daily.{column} + EXCLUDED.{column}" for column in COUNTER_FIELDS)}
+"""
+
+# Every tracked event looks up the user's city, which rarely changes
+_user_city_cache = TTLCache(maxsize=16384, ttl=600)
+_MISSING = object()
+
+# Tracked views, clicks and conversions are queued in memory and written by one
+# background thread in batches (every 200ms, at most 500 events per batch)
+TRACKING_FLUSH_INTERVAL = 0.2
+TRACKING_FLUSH_MAX_ITEMS = 500
+_tracking_queue = queue.Queue()
+_tracking_lock = threading.Lock()
+_tracking_writer = None
+
+def invalidate_user_city(user_id):
+    """Drop a cached city after the user's profile changes or is deleted"""
+    _user_city_cache.pop(int(user_id), None)
 
 class OfferAnalytics:
     """Handle analytics data specifically for the offer_analytics table"""
     
     @staticmethod
-    def track_offer_interaction(offer_id, user_id=None, event_type='view'):
-        """Track user interactions with offers and include user city information"""
+    def create_indexes():
+        """Add the unique (offer_id, date) constraint the tracking upserts rely on
+        
+        Rows duplicated before the constraint existed are merged into the oldest
+        one first. A valid index left by an earlier concurrent build is adopted as
+        the constraint; an invalid one is dropped and the constraint built here.
+        """
+        sums = ', '.join(f"COALESCE(SUM({column}), 0) AS {column}" for column in COUNTER_FIELDS)
+        merged = ', '.join(f"{column} = g.{column}" for column in COUNTER_FIELDS)
+        
         try:
-            today = date.today()
-            user_city = None
-            
-            # Get user city if user_id is provided
-            if user_id:
-                user_city = OfferAnalytics._get_user_city(user_id)
-            
-            print(f"📊 Tracking {event_type} for offer {offer_id}, user {user_id}, city: {user_city}")
-            
-            # Check if this user has already been tracked for this offer today
-            if user_id and OfferAnalytics._is_user_already_tracked_today(offer_id, user_id, today):
-                print(f"⚠️ User {user_id} already tracked for offer {offer_id} today - skipping")
-                return True  # Return True but don't increment counters
-            
-            # Check if record exists for this offer and date
             with get_db_connection() as conn:
-                with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT pg_advisory_xact_lock(hashtext('offer_analytics_offer_date_key'))")
                     cursor.execute("""
-                        SELECT id FROM offer_analytics 
-                        WHERE offer_id = %s AND date = %s
-                    """, (offer_id, today))
-                    existing_record = cursor.fetchone()
+                        SELECT 1 FROM pg_constraint
+                        WHERE conname = 'offer_analytics_offer_date_key' AND conrelid = 'offer_analytics'::regclass
+                    """)
+                    if cursor.fetchone():
+                        print('✅ Offer analytics indexes ready')
+                        return
                     
-                    if not existing_record:
-                        # Create new record with default values
+                    cursor.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass('offer_analytics_offer_date_key')")
+                    index = cursor.fetchone()
+                    if index and index[0]:
                         cursor.execute("""
-                            INSERT INTO offer_analytics 
-                            (offer_id, date, views, clicks, conversions, 
-                             conversion_calls, conversion_directions, conversion_website,
-                             user_id, user_city, created_at) 
-                            VALUES (%s, %s, 0, 0, 0, 0, 0, 0, %s, %s, CURRENT_TIMESTAMP)
-                        """, (offer_id, today, user_id, user_city))
-                        conn.commit()
-                        print(f"📝 Created new offer_analytics record for offer {offer_id} on {today}")
-            
-            # Update the appropriate counter based on event type
-            field_mapping = {
-                'view': 'views',
-                'click': 'clicks',
-                'conversion': 'conversions'
-            }
+                            ALTER TABLE offer_analytics
+                            ADD CONSTRAINT offer_analytics_offer_date_key UNIQUE USING INDEX offer_analytics_offer_date_key
+                        """)
+                    else:
+                        if index:
+                            print('⚠️ Dropping invalid index offer_analytics_offer_date_key')
+                            cursor.execute("DROP INDEX offer_analytics_offer_date_key")
+                        
+                        # Keep writers out until the duplicates are merged and the constraint exists
+                        cursor.execute("LOCK TABLE offer_analytics IN SHARE ROW EXCLUSIVE MODE")
+                        cursor.execute(f"""
+                            WITH groups AS (
+                                SELECT offer_id, date, MIN(id) AS keep_id, {sums},
+                                       (ARRAY_AGG(user_id ORDER BY id) FILTER (WHERE user_id IS NOT NULL))[1] AS user_id,
+                                       (ARRAY_AGG(user_city ORDER BY id) FILTER (WHERE user_city IS NOT NULL))[1] AS user_city
+                                FROM offer_analytics
+                                GROUP BY offer_id, date
+                                HAVING COUNT(*) > 1
+                            ), merged AS (
+                                UPDATE offer_analytics o SET {merged}, user_id = g.user_id, user_city = g.user_city
+                                FROM groups g
+                                WHERE o.id = g.keep_id
+                            )
+                            DELETE FROM offer_analytics o
+                            USING groups g
+                            WHERE o.offer_id = g.offer_id AND o.date = g.date AND o.id <> g.keep_id
+                            RETURNING o.date
+                        """)
+                        merged_dates = sorted({row[0] for row in cursor.fetchall()})
+                        if merged_dates:
+                            print(f'⚠️ Merged duplicate offer_analytics rows on {len(merged_dates)} days')
+                            OfferAnalytics._rebuild_city_rollup(cursor, merged_dates)
+                        cursor.execute("""
+                            ALTER TABLE offer_analytics
+                            ADD CONSTRAINT offer_analytics_offer_date_key UNIQUE (offer_id, date)
+                        """)
+                    conn.commit()
             
-            field = field_mapping.get(event_type)
-            if not field:
-                print(f"⚠️ Unknown event type for offer analytics: {event_type}")
-                return False
+            print('✅ Offer analytics indexes ready')
             
-            # Update the counter and user information
+        except Exception as error:
+            print(f'❌ Error creating offer analytics indexes: {error}')
+            raise error
+    
+    @staticmethod
+    def _rebuild_city_rollup(cursor, dates):
+        """Recompute city_analytics_daily for dates from offer_analytics, if the roll-up exists"""
+        cursor.execute("SELECT to_regclass('city_analytics_daily') IS NOT NULL")
+        if not cursor.fetchone()[0]:
+            return
+        
+        cursor.execute("DELETE FROM city_analytics_daily WHERE date = ANY(%s)", (dates,))
+        cursor.execute(f"""
+            INSERT INTO city_analytics_daily (user_city, date, {', '.join(COUNTER_FIELDS)})
+            SELECT COALESCE(user_city, 'Unknown'), date,
+                   {', '.join(f"COALESCE(SUM({column}), 0)" for column in COUNTER_FIELDS)}
+            FROM offer_analytics
+            WHERE date = ANY(%s)
+            GROUP BY 1, 2
+        """, (dates,))
+    
+    @staticmethod
+    def update_database_schema():
+        """Create the city_analytics_daily roll-up, backfilled from offer_analytics once
+        
+        The batch writer keeps the roll-up in sync in the same transaction as its
+        offer_analytics changes; the row trigger that used to do this is dropped.
+        """
+        columns = ', '.join(COUNTER_FIELDS)
+        
+        try:
             with get_db_connection() as conn:
                 with conn.cursor() as cursor:
+                    # Serialize concurrent migrations
+                    cursor.execute("SELECT pg_advisory_xact_lock(hashtext('city_analytics_daily'))")
+                    cursor.execute("SELECT to_regclass('city_analytics_daily') IS NULL")
+                    created = cursor.fetchone()[0]
+                    
+                    if created:
+                        # Keep writers out until the backfill below is committed
+                        cursor.execute("LOCK TABLE offer_analytics IN SHARE ROW EXCLUSIVE MODE")
+                    
                     cursor.execute(f"""
-                        UPDATE offer_analytics 
-                        SET {field} = {field} + 1,
-                            user_id = COALESCE(user_id, %s),
-                            user_city = COALESCE(user_city, %s)
-                        WHERE offer_id = %s AND date = %s
-                    """, (user_id, user_city, offer_id, today))
+                        CREATE TABLE IF NOT EXISTS city_analytics_daily (
+                            user_city VARCHAR(100) NOT NULL,
+                            date DATE NOT NULL,
+                            {', '.join(f"{column} BIGINT NOT NULL DEFAULT 0" for column in COUNTER_FIELDS)},
+                            PRIMARY KEY (user_city, date)
+                        );
+                        
+                        DROP TRIGGER IF EXISTS offer_analytics_city_rollup ON offer_analytics;
+                        DROP FUNCTION IF EXISTS city_analytics_daily_sync();
+                    """)
+                    
+                    if created:
+                        cursor.execute(f"""
+                            INSERT INTO city_analytics_daily (user_city, date, {columns})
+                            SELECT COALESCE(user_city, 'Unknown'), date,
+                                   {', '.join(f"COALESCE(SUM({column}), 0)" for column in COUNTER_FIELDS)}
+                            FROM offer_analytics
+                            GROUP BY 1, 2
+                        """)
                     conn.commit()
             
-            print(f"✅ Updated {event_type} for offer {offer_id} on {today} with city {user_city}")
-            return True
-                    
+            print('✅ Offer analytics schema up to date')
+            
         except Exception as error:
-            print(f'❌ Error tracking offer interaction: {error}')
-            import traceback
-            traceback.print_exc()
+            print(f'❌ Error updating offer analytics schema: {error}')
+            raise error
+
+    @staticmethod
+    def delete_user_rows(cursor, user_id):
+        """Delete a user's offer_analytics rows and take their counts out of city_analytics_daily"""
+        cursor.execute(f"""
+            WITH deleted AS (
+                DELETE FROM offer_analytics WHERE user_id = %s
+                RETURNING user_city, date, {', '.join(COUNTER_FIELDS)}
+            )
+            INSERT INTO city_analytics_daily (user_city, date, {', '.join(COUNTER_FIELDS)})
+            SELECT COALESCE(user_city, 'Unknown'), date,
+                   {', '.join(f"-COALESCE(SUM({column}), 0)" for column in COUNTER_FIELDS)}
+            FROM deleted
+            GROUP BY 1, 2
+            ORDER BY 1, 2
+            ON CONFLICT (user_city, date) DO UPDATE SET
+                {', '.join(f"{column} = city_analytics_daily.{column} + EXCLUDED.{column}" for column in COUNTER_FIELDS)}
+        """, (user_id,))
+    
+    @staticmethod
+    def track_offer_interaction(offer_id, user_id=None, event_type='view'):
+        """Queue a user interaction with an offer; written with the user's city in the background"""
+        # Map event types to database fields
+        field_mapping = {
+            'view': 'views',
+            'click': 'clicks',
+            'conversion': 'conversions'
+        }
+        
+        field = field_mapping.get(event_type)
+        if not field:
+            print(f"⚠️ Unknown event type for offer analytics: {event_type}")
             return False
+        
+        return OfferAnalytics._enqueue(offer_id, user_id, (field,))
 
     @staticmethod
     def track_conversion(offer_id, conversion_type, user_id=None):
-        """Track specific conversion types with user city information"""
+        """Queue a specific conversion type; written with the user's city in the background"""
+        # Map conversion types to database fields
+        conversion_field_mapping = {
+            'website': 'conversion_website',
+            'call': 'conversion_calls',
+            'directions': 'conversion_directions'
+        }
+        
+        field = conversion_field_mapping.get(conversion_type)
+        if not field:
+            print(f"⚠️ Unknown conversion type for offer analytics: {conversion_type}")
+            return False
+        
+        # Bump the specific conversion counter and total conversions together
+        return OfferAnalytics._enqueue(offer_id, user_id, (field, 'conversions'))
+
+    @staticmethod
+    def _enqueue(offer_id, user_id, fields):
+        """Queue one tracked event for the background writer"""
         try:
-            today = date.today()
-            user_city = None
-            
-            # Get user city if user_id is provided
-            if user_id:
-                user_city = OfferAnalytics._get_user_city(user_id)
+            _tracking_queue.put_nowait((int(offer_id), int(user_id) if user_id else None, fields, date.today()))
+        except (TypeError, ValueError) as error:
+            print(f'❌ Error tracking offer interaction: {error}')
+            return False
+        
+        OfferAnalytics._start_tracking_writer()
+        return True
+
+    @staticmethod
+    def flush():
+        """Write queued events in batches of up to TRACKING_FLUSH_MAX_ITEMS"""
+        while True:
+            batch = []
+            while len(batch) < TRACKING_FLUSH_MAX_ITEMS:
+                try:
+                    batch.append(_tracking_queue.get_nowait())
+                except queue.Empty:
+                    break
             
-            print(f"📊 Tracking {conversion_type} conversion for offer {offer_id}, user {user_id}, city: {user_city}")
+            if not batch:
+                return
             
-            # Check if this user has already performed this specific conversion type today
-            if user_id and OfferAnalytics._has_user_converted_today(offer_id, user_id, conversion_type, today):
-                print(f"⚠️ User {user_id} already performed {conversion_type} conversion for offer {offer_id} today - skipping")
-                return True  # Return True but don't increment counters
+            try:
+                OfferAnalytics._write_batch(batch)
+            except Exception as error:
+                print(f'❌ Error writing offer analytics batch: {error}')
+                logger.debug("offer analytics batch failed", exc_info=True)
             
-            # Check if record exists for this offer and date
-            with get_db_connection() as conn:
-                with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
-                    cursor.execute("""
-                        SELECT id FROM offer_analytics 
-                        WHERE offer_id = %s AND date = %s
-                    """, (offer_id, today))
-                    existing_record = cursor.fetchone()
+            if len(batch) < TRACKING_FLUSH_MAX_ITEMS:
+                return
+
+    @staticmethod
+    def _write_batch(batch):
+        """Sum queued events per (offer, date) and write them, with the city roll-up, in one transaction
+        
+        A user who is already the row's user for the day is not counted again
+        (for conversions: once that conversion type has been counted), exactly
+        as if the events had been written one at a time.
+        """
+        keys = sorted({(offer_id, event_date) for offer_id, _, _, event_date in batch})
+        key_columns = ([offer_id for offer_id, _ in keys], [event_date for _, event_date in keys])
+        
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                # Rows are created and then locked in key order, so writers in other
+                # worker processes can't deadlock against this batch
+                execute_prepared(cursor, 'offer_analytics_batch_create_rows', _BATCH_CREATE_ROWS_SQL, key_columns)
+                created = cursor.rowcount
+                execute_prepared(cursor, 'offer_analytics_batch_rows', _BATCH_ROWS_SQL, key_columns)
+                rows = {
+                    (row[0], row[1]): {'user_id': row[2], 'user_city': row[3], **dict(zip(COUNTER_FIELDS, row[4:]))}
+                    for row in cursor.fetchall()
+                }
+                
+                # Only the counts added by this batch are written; the row state is replayed in memory
+                deltas = {}
+                for offer_id, user_id, fields, event_date in batch:
+                    key = (offer_id, event_date)
+                    row = rows[key]
+                    # Interactions count once per user, conversions once per user and type
+                    if user_id and row['user_id'] == user_id and (len(fields) == 1 or row[fields[0]] > 0):
+                        continue
                     
-                    if not existing_record:
-                        # Create new record with default values
-                        cursor.execute("""
-                            INSERT INTO offer_analytics 
-                            (offer_id, date, views, clicks, conversions, 
-                             conversion_calls, conversion_directions, conversion_website,
-                             user_id, user_city, created_at) 
-                            VALUES (%s, %s, 0, 0, 0, 0, 0, 0, %s, %s, CURRENT_TIMESTAMP)
-                        """, (offer_id, today, user_id, user_city))
-                        conn.commit()
-                        print(f"📝 Created new offer_analytics record for offer {offer_id} on {today}")
-            
-            # Map conversion types to database fields
-            conversion_field_mapping = {
-                'website': 'conversion_website',
-                'call': 'conversion_calls',
-                'directions': 'conversion_directions'
-            }
-            
-            field = conversion_field_mapping.get(conversion_type)
-            if not field:
-                print(f"⚠️ Unknown conversion type for offer analytics: {conversion_type}")
-                return False
-            
-            # Update the specific conversion counter, total conversions, and user information
-            with get_db_connection() as conn:
-                with conn.cursor() as cursor:
-                    cursor.execute(f"""
-                        UPDATE offer_analytics 
-                        SET {field} = {field} + 1,
-                            conversions = conversions + 1,
-                            user_id = COALESCE(user_id, %s),
-                            user_city = COALESCE(user_city, %s)
-                        WHERE offer_id = %s AND date = %s
-                    """, (user_id, user_city, offer_id, today))
+                    delta = deltas.setdefault(key, {'user_id': None, **{column: 0 for column in COUNTER_FIELDS}})
+                    for column in fields:
+                        row[column] += 1
+                        delta[column] += 1
+                    if row['user_id'] is None and user_id:
+                        row['user_id'] = delta['user_id'] = user_id
+                
+                if not deltas:
                     conn.commit()
-            
-            print(f"✅ Tracked {conversion_type} conversion for offer {offer_id} on {today} with city {user_city}")
-            return True
-                    
-        except Exception as error:
-            print(f'❌ Error tracking conversion: {error}')
-            import traceback
-            traceback.print_exc()
-            return False
+                    return
+                
+                # Only users that become a row's user need a city; cache misses are read on this cursor
+                cities = OfferAnalytics._get_user_cities(
+                    {delta['user_id'] for delta in deltas.values() if delta['user_id']}, cursor
+                )
+                
+                # One array per column keeps the statement text fixed
+                row_keys = sorted(deltas)
+                columns = [
+                    [offer_id for offer_id, _ in row_keys],
+                    [event_date for _, event_date in row_keys],
+                    *([deltas[key][column] for key in row_keys] for column in COUNTER_FIELDS),
+                    [deltas[key]['user_id'] for key in row_keys],
+                    [cities.get(deltas[key]['user_id']) for key in row_keys],
+                ]
+                execute_prepared(cursor, 'offer_analytics_batch_update', _BATCH_UPDATE_SQL, columns)
+                
+                # Each row's counts belong to its city; a row that gets its first city
+                # moves the counts it already had out of 'Unknown'
+                rollup = {}
+                for key in row_keys:
+                    row, delta = rows[key], deltas[key]
+                    # Mirrors COALESCE(o.user_city, t.user_city) and the roll-up's COALESCE(user_city, 'Unknown')
+                    city = row['user_city'] if row['user_city'] is not None else cities.get(delta['user_id'])
+                    old_city = 'Unknown' if row['user_city'] is None else row['user_city']
+                    new_city = 'Unknown' if city is None else city
+                    bucket = rollup.setdefault((new_city, key[1]), dict.fromkeys(COUNTER_FIELDS, 0))
+                    for column in COUNTER_FIELDS:
+                        bucket[column] += delta[column]
+                    if new_city != old_city:
+                        old_bucket = rollup.setdefault((old_city, key[1]), dict.fromkeys(COUNTER_FIELDS, 0))
+                        for column in COUNTER_FIELDS:
+                            moved = row[column] - delta[column]
+                            old_bucket[column] -= moved
+                            bucket[column] += moved
+                
+                # Locked in (city, date) order, like the offer_analytics rows above
+                city_keys = sorted(rollup)
+                execute_prepared(cursor, 'offer_analytics_city_rollup', _CITY_ROLLUP_SQL, [
+                    [city for city, _ in city_keys],
+                    [event_date for _, event_date in city_keys],
+                    *([rollup[key][column] for key in city_keys] for column in COUNTER_FIELDS),
+                ])
+                conn.commit()
+        
+        logger.debug("✅ Wrote %d offer analytics events to %d offer_analytics rows (%d new), %d city rows",
+                     len(batch), len(deltas), created, len(city_keys))
 
     @staticmethod
-    def _is_user_already_tracked_today(offer_id, user_id, event_date):
-        """Check if user has already been tracked for this offer today by looking at existing records"""
-        try:
-            with get_db_connection() as conn:
-                with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
-                    # Check if there's already a record with this user_id for this offer and date
-                    cursor.execute("""
-                        SELECT id FROM offer_analytics 
-                        WHERE offer_id = %s AND user_id = %s AND date = %s
-                    """, (offer_id, user_id, event_date))
-                    existing_record = cursor.fetchone()
-                    
-                    return existing_record is not None
-                    
-        except Exception as error:
-            print(f'❌ Error checking if user already tracked: {error}')
-            return False  # If there's an error, allow tracking to prevent blocking
+    def _start_tracking_writer():
+        """Start the background offer analytics writer once per process"""
+        global _tracking_writer
+        if _tracking_writer is not None:
+            return
+        
+        with _tracking_lock:
+            if _tracking_writer is not None:
+                return
+            _tracking_writer = threading.Thread(target=_run_tracking_writer, name="offer-analytics-writer", daemon=True)
+            _tracking_writer.start()
+        atexit.register(OfferAnalytics.flush)
 
     @staticmethod
-    def _get_user_city(user_id):
-        """Get user's city from the users table"""
-        try:
-            with get_db_connection() as conn:
-                with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
-                    cursor.execute("SELECT city FROM users WHERE id = %s", (user_id,))
-                    result = cursor.fetchone()
-                    
-                    if result and result['city']:
-                        return result['city']
-                    else:
-                        return None  # City not set for this user
-                        
-        except Exception as error:
-            print(f'❌ Error getting user city: {error}')
-            return None
+    def _get_user_cities(user_ids, cursor):
+        """Map user ids to their city (None when not set), reading cache misses in one query on cursor"""
+        cities = {}
+        missing = []
+        for user_id in user_ids:
+            cached = _user_city_cache.get(user_id, _MISSING)
+            if cached is _MISSING:
+                missing.append(user_id)
+            else:
+                cities[user_id] = cached
+        
+        if missing:
+            cursor.execute("SELECT id, city FROM users WHERE id = ANY(%s)", (missing,))
+            found = dict(cursor.fetchall())
+            for user_id in missing:
+                # None is cached too when the city is not set for this user
+                cities[user_id] = found.get(user_id) or None
+                _user_city_cache.set(user_id, cities[user_id])
+        
+        return cities
 
     @staticmethod
     def get_city_analytics(start_date=None, end_date=None):
@@ -199,34 +444,56 @@ class OfferAnalytics:
             
             if start_date and end_date:
                 date_filter = "WHERE date BETWEEN %s AND %s"
-                params = [start_date, end_date]
+                params = [start_date, end_date, start_date, end_date]
             
+            # Counters come from the per-city daily roll-up; distinct offers don't roll up
+            # across days, so unique_offers is still counted from offer_analytics
             query = f"""
+            WITH totals AS (
+                SELECT 
+                    user_city as city,
+                    SUM(views)::bigint as total_views,
+                    SUM(clicks)::bigint as total_clicks,
+                    SUM(conversions)::bigint as total_conversions,
+                    SUM(conversion_calls)::bigint as total_calls,
+                    SUM(conversion_directions)::bigint as total_directions,
+                    SUM(conversion_website)::bigint as total_website
+                FROM city_analytics_daily 
+                {date_filter}
+                GROUP BY user_city
+            ),
+            offers AS (
+                SELECT 
+                    COALESCE(user_city, 'Unknown') as city,
+                    COUNT(DISTINCT offer_id) as unique_offers
+                FROM offer_analytics 
+                {date_filter}
+                GROUP BY 1
+            )
             SELECT 
-                COALESCE(user_city, 'Unknown') as city,
-                SUM(views) as total_views,
-                SUM(clicks) as total_clicks,
-                SUM(conversions) as total_conversions,
-                SUM(conversion_calls) as total_calls,
-                SUM(conversion_directions) as total_directions,
-                SUM(conversion_website) as total_website,
-                COUNT(DISTINCT offer_id) as unique_offers,
+                t.city,
+                t.total_views,
+                t.total_clicks,
+                t.total_conversions,
+                t.total_calls,
+                t.total_directions,
+                t.total_website,
+                COALESCE(o.unique_offers, 0) as unique_offers,
                 ROUND(
-                    SUM(conversions)::numeric / 
-                    NULLIF(SUM(views), 0) * 100, 2
+                    t.total_conversions::numeric / 
+                    NULLIF(t.total_views, 0) * 100, 2
                 ) as conversion_rate
-            FROM offer_analytics 
-            {date_filter}
-            GROUP BY user_city
-            ORDER BY total_views DESC
+            FROM totals t
+            LEFT JOIN offers o ON o.city = t.city
+            ORDER BY t.total_views DESC
             """
             
-            with get_db_connection() as conn:
+            with get_db_connection(autocommit=True) as conn:
                 with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
                     cursor.execute(query, params)
                     results = cursor.fetchall()
             
-            return [dict(row) for row in results]
+            return results
             
         except Exception as error:
             print(f'❌ Error getting city analytics: {error}')
@@ -264,12 +531,12 @@ class OfferAnalytics:
             ORDER BY views DESC
             """
             
-            with get_db_connection() as conn:
+            with get_db_connection(autocommit=True) as conn:
                 with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
                     cursor.execute(query, params)
                     results = cursor.fetchall()
             
-            return [dict(row) for row in results]
+            return results
             
         except Exception as error:
             print(f'❌ Error getting offer city breakdown: {error}')
@@ -277,35 +544,8 @@ class OfferAnalytics:
             traceback.print_exc()
             return []
 
-    @staticmethod
-    def _has_user_converted_today(offer_id, user_id, conversion_type, event_date):
-        """Check if user has already performed this specific conversion type today using existing data"""
-        try:
-            with get_db_connection() as conn:
-                with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
-                    # Check existing offer_analytics records to see if user has already converted today
-                    # We'll look for records where this user_id appears with the same offer_id and date
-                    # and has already performed this specific conversion type
-                    
-                    conversion_field_mapping = {
-                        'website': 'conversion_website',
-                        'call': 'conversion_calls', 
-                        'directions': 'conversion_directions'
-                    }
-                    
-                    field = conversion_field_mapping.get(conversion_type)
-                    if not field:
-                        return False
-                    
-                    # Check if there's already a record for this user-offer-date with this conversion type > 0
-                    cursor.execute(f"""
-                        SELECT id FROM offer_analytics 
-                        WHERE offer_id = %s AND user_id = %s AND date = %s AND {field} > 0
-                    """, (offer_id, user_id, event_date))
-                    existing_record = cursor.fetchone()
-                    
-                    return existing_record is not None
-                    
-        except Exception as error:
-            print(f'❌ Error checking user conversion: {error}')
-            return False  # If there's an error, allow tracking to prevent blocking 
\ No newline at end of file
+def _run_tracking_writer():
+    """Background loop flushing queued offer analytics events"""
+    while True:
+        time.sleep(TRACKING_FLUSH_INTERVAL)
+        OfferAnalytics.flush()
@@ -1,9 +1,50 @@
 #!/usr/bin/env python3
 
-import psycopg2
-import psycopg2.extras
+import logging
 from datetime import date
-from config.database import get_db_connection
+from config.database import get_db_connection, execute_prepared
+from models.analytics import Analytics
+
+logger = logging.getLogger(__name__)
+
+# Counter columns of business_analytics, in table order
+COUNTER_FIELDS = ('total_views', 'total_clicks', 'total_conversions',
+                  'conversion_calls', 'conversion_directions', 'conversion_website')
+
+# Fields the trackers below may bump directly
+TRACKED_FIELDS = {'total_views', 'total_clicks', 'conversion_calls', 'conversion_directions', 'conversion_website'}
+
+def _build_upsert(field_name, is_conversion):
+    """Statement name and SQL bumping field_name (and total_conversions) for one offer's business"""
+    counters = {column: 0 for column in COUNTER_FIELDS}
+    counters[field_name] = 1
+    increments = [f"{field_name} = business_analytics.{field_name} + 1"]
+    if is_conversion:
+        counters['total_conversions'] = 1
+        increments.append("total_conversions = business_analytics.total_conversions + 1")
+    
+    statement = f"simple_analytics_{field_name}_conversion" if is_conversion else f"simple_analytics_{field_name}"
+    return statement, f"""
+        WITH b AS (
+            SELECT business_id FROM offers WHERE id = %s
+        )
+        INSERT INTO business_analytics 
+        (business_id, date, {', '.join(COUNTER_FIELDS)}, 
+         total_spent, active_offers, created_at) 
+        SELECT b.business_id, %s, {', '.join(str(v) for v in counters.values())},
+               0, 0, CURRENT_TIMESTAMP
+        FROM b
+        ON CONFLICT (business_id, date) DO UPDATE SET
+            {', '.join(increments)}
+        RETURNING business_id, (xmax = 0) AS inserted
+    """
+
+# (statement name, SQL) per (field, is_conversion), built once at import and PREPAREd per connection
+_UPSERT_SQL = {
+    (field_name, is_conversion): _build_upsert(field_name, is_conversion)
+    for field_name in TRACKED_FIELDS
+    for is_conversion in (False, True)
+}
 
 class SimpleAnalytics:
     """Simple analytics that work directly with business_analytics table"""
@@ -37,81 +78,38 @@ class SimpleAnalytics:
     def _update_business_analytics(offer_id, field_name, is_conversion=False):
         """Update business_analytics table directly"""
         try:
-            print(f"📊 Tracking {field_name} for offer {offer_id}")
+            logger.debug("📊 Tracking %s for offer %s", field_name, offer_id)
             
-            # Get the business_id for this offer
-            with get_db_connection() as conn:
-                with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
-                    cursor.execute("SELECT business_id FROM offers WHERE id = %s", (offer_id,))
-                    offer_result = cursor.fetchone()
-                    
-                    if not offer_result:
-                        print(f"⚠️ Offer {offer_id} not found")
-                        return False
-                    
-                    business_id = offer_result['business_id']
-                    today = date.today()
+            upsert = _UPSERT_SQL.get((field_name, is_conversion))
+            if not upsert:
+                print(f"⚠️ Unknown business_analytics field: {field_name}")
+                return False
             
-            # Check if record exists for this business and date, create if not
-            with get_db_connection() as conn:
-                with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
-                    cursor.execute("""
-                        SELECT id FROM business_analytics 
-                        WHERE business_id = %s AND date = %s
-                    """, (business_id, today))
-                    existing_record = cursor.fetchone()
-                    
-                    if not existing_record:
-                        # Create new record with default values
-                        cursor.execute("""
-                            INSERT INTO business_analytics 
-                            (business_id, date, total_views, total_clicks, total_conversions, 
-                             total_spent, active_offers, conversion_calls, conversion_directions, 
-                             conversion_website, created_at) 
-                            VALUES (%s, %s, 0, 0, 0, 0, 0, 0, 0, 0, CURRENT_TIMESTAMP)
-                        """, (business_id, today))
-                        conn.commit()
-                        print(f"📝 Created new business_analytics record for business {business_id} on {today}")
+            today = date.today()
+            statement, query = upsert
             
-            # Update the specific field and total conversions if applicable
+            # Look up the business and create or bump today's row in one statement
             with get_db_connection() as conn:
                 with conn.cursor() as cursor:
-                    if is_conversion:
-                        # Update both the specific conversion field and total_conversions
-                        cursor.execute(f"""
-                            UPDATE business_analytics 
-                            SET {field_name} = {field_name} + 1,
-                                total_conversions = total_conversions + 1
-                            WHERE business_id = %s AND date = %s
-                        """, (business_id, today))
-                    else:
-                        # Update only the specific field
-                        cursor.execute(f"""
-                            UPDATE business_analytics 
-                            SET {field_name} = {field_name} + 1
-                            WHERE business_id = %s AND date = %s
-                        """, (business_id, today))
-                    
-                    # Also update active_offers count for this business
-                    cursor.execute("""
-                        UPDATE business_analytics 
-                        SET active_offers = (
-                            SELECT COUNT(*) 
-                            FROM offers 
-                            WHERE business_id = %s 
-                            AND status = 'approved' 
-                            AND (expires_at IS NULL OR expires_at > CURRENT_TIMESTAMP)
-                        )
-                        WHERE business_id = %s AND date = %s
-                    """, (business_id, business_id, today))
-                    
+                    execute_prepared(cursor, statement, query, (offer_id, today))
+                    result = cursor.fetchone()
                     conn.commit()
             
-            print(f"✅ Updated {field_name} for business {business_id} on {today}")
+            if not result:
+                print(f"⚠️ Offer {offer_id} not found")
+                return False
+            
+            business_id, inserted = result
+            
+            # active_offers is recounted in the background, at most every few minutes per business
+            Analytics._schedule_active_offers_refresh([business_id], today)
+            
+            if inserted:
+                logger.debug("📝 Created new business_analytics record for business %s on %s", business_id, today)
+            logger.debug("✅ Updated %s for business %s on %s", field_name, business_id, today)
             return True
                     
         except Exception as error:
             print(f'❌ Error updating business_analytics: {error}')
-            import traceback
-            traceback.print_exc()
+            logger.debug("business_analytics update failed", exc_info=True)
             return False 
\ No newline at end of file
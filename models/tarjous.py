@@ -1,36 +1,120 @@
 import uuid
+import base64
 from datetime import datetime
-from config.database import get_db_connection
+from config.database import get_db_connection, execute_prepared, create_index_concurrently
+from utils.cache import TTLCache
+import orjson
 import psycopg2.extras
 
+# Tracking endpoints only need to know an offer is live; a short TTL bounds staleness
+_live_offer_cache = TTLCache(maxsize=100000, ttl=60)
+
+# Listing totals per (category, city) barely move, so later pages reuse page 1's count
+_offer_count_cache = TTLCache(maxsize=1024, ttl=30)
+
+# Serialized get_offers() pages for the feed endpoints, keyed by their arguments
+_offer_page_json_cache = TTLCache(maxsize=512, ttl=30)
+
+# Wraps a page query aliased as p and adds each offer's additional images (primary excluded),
+# so offer_images is read once per returned row instead of once per offer in to_dict()
+_WITH_ADDITIONAL_IMAGES = """
+            SELECT p.*, COALESCE(ai.urls, '{{}}') AS additional_images
+            FROM ({page_query}) p
+            LEFT JOIN LATERAL (
+                SELECT array_agg(image_url ORDER BY "order" ASC, created_at ASC)
+                       FILTER (WHERE image_url IS NOT NULL AND image_url IS DISTINCT FROM p.image_url) AS urls
+                FROM offer_images 
+                WHERE offer_id = p.id
+            ) ai ON true
+            ORDER BY {order_by}
+"""
+
+# Offer columns (plus business columns from the JOIN) and their defaults when missing
+_OFFER_FIELDS = (
+    ('id', None), ('title', None), ('description', None), ('keywords', None),
+    ('category', None), ('offer_type', None), ('status', 'approved'), ('is_premium', False),
+    ('cost', None), ('created_at', None), ('expires_at', None), ('approved_at', None),
+    ('address', None), ('city', None), ('image_url', None), ('starts_at', None),
+    ('image_s3_key', None), ('is_nationwide', False), ('location_type', None),
+    ('offer_url', None), ('business_id', None),
+    ('business_name', None), ('phone', None), ('email', None),
+)
+
+# Business columns come from the businesses JOIN, everything else from offers
+_BUSINESS_COLUMNS = ('business_name', 'phone', 'email')
+
+# Explicit select list for offer queries, only the columns Tarjous and _row_to_offer_dict read
+_OFFER_COLUMNS = ', '.join(
+    f'b.{name}' if name in _BUSINESS_COLUMNS else f'o.{name}' for name, _ in _OFFER_FIELDS
+)
+
+def _iso(value):
+    """ISO 8601 string for a date/datetime, or None"""
+    return value.isoformat() if value else None
+
+def _row_to_offer_dict(row, additional_images):
+    """Build the API offer dictionary straight from a query row (list endpoints skip Tarjous)"""
+    iso = _iso
+    category = row.get('category')
+    business_name = row.get('business_name')
+    address = row.get('address')
+    phone = row.get('phone')
+    offer_url = row.get('offer_url')
+    # Each timestamp is formatted once even where the API repeats it under two keys
+    starts_at = iso(row.get('starts_at'))
+    expires_at = iso(row.get('expires_at'))
+    status = row.get('status', 'approved')
+    cost = row.get('cost')
+    
+    return {
+        'id': row.get('id'),
+        'title': row.get('title'),
+        'description': row.get('description'),
+        'keywords': row.get('keywords'),
+        'imageUrl': row.get('image_url'),
+        'additionalImages': additional_images,
+        'categoryName': category,
+        'category': category,
+        'offerType': row.get('offer_type'),
+        'merchantName': business_name,
+        'businessName': business_name,
+        'merchantAddress': address,
+        'businessAddress': address,
+        'address': address,
+        'merchantPhone': phone,
+        'businessPhone': phone,
+        'phone': phone,
+        'merchantWebsite': offer_url,
+        'businessWebsite': offer_url,
+        'website': offer_url,
+        'offerUrl': offer_url,
+        'email': row.get('email'),
+        'validFrom': starts_at,
+        'validUntil': expires_at,
+        'startsAt': starts_at,
+        'expiresAt': expires_at,
+        'isActive': status == 'approved',
+        'status': status,
+        'createdAt': iso(row.get('created_at')),
+        'approvedAt': iso(row.get('approved_at')),
+        'city': row.get('city'),
+        'businessId': row.get('business_id'),
+        'isPremium': row.get('is_premium', False),
+        'isNationwide': row.get('is_nationwide', False),
+        'locationType': row.get('location_type'),
+        'cost': float(cost) if cost else None,
+        'imageS3Key': row.get('image_s3_key')
+    }
+
 class Tarjous:
+    __slots__ = tuple(name for name, _ in _OFFER_FIELDS) + ('_additional_images',)
+    
     def __init__(self, tarjous_data):
-        self.id = tarjous_data.get('id')
-        self.title = tarjous_data.get('title')
-        self.description = tarjous_data.get('description')
-        self.keywords = tarjous_data.get('keywords')
-        self.category = tarjous_data.get('category')
-        self.offer_type = tarjous_data.get('offer_type')
-        self.status = tarjous_data.get('status', 'approved')
-        self.is_premium = tarjous_data.get('is_premium', False)
-        self.cost = tarjous_data.get('cost')
-        self.created_at = tarjous_data.get('created_at')
-        self.expires_at = tarjous_data.get('expires_at')
-        self.approved_at = tarjous_data.get('approved_at')
-        self.address = tarjous_data.get('address')
-        self.city = tarjous_data.get('city')
-        self.image_url = tarjous_data.get('image_url')
-        self.starts_at = tarjous_data.get('starts_at')
-        self.image_s3_key = tarjous_data.get('image_s3_key')
-        self.is_nationwide = tarjous_data.get('is_nationwide', False)
-        self.location_type = tarjous_data.get('location_type')
-        self.offer_url = tarjous_data.get('offer_url')
-        self.business_id = tarjous_data.get('business_id')
+        for name, default in _OFFER_FIELDS:
+            setattr(self, name, tarjous_data.get(name, default))
         
-        # Business information from JOIN
-        self.business_name = tarjous_data.get('business_name')
-        self.phone = tarjous_data.get('phone')
-        self.email = tarjous_data.get('email')
+        # None means additional images are queried on demand in to_dict()
+        self._additional_images = tarjous_data.get('additional_images')
 
     def get_additional_images(self):
         """Get additional images from offer_images table (excluding primary image)"""
@@ -59,48 +143,12 @@ class Tarjous:
 
     def to_dict(self):
         """Convert tarjous object to dictionary"""
-        # Get additional images from offer_images table
-        additional_images = self.get_additional_images()
+        # Get additional images from offer_images table unless the row already carried them
+        additional_images = self._additional_images
+        if additional_images is None:
+            additional_images = self.get_additional_images()
         
-        return {
-            'id': self.id,
-            'title': self.title,
-            'description': self.description,
-            'keywords': self.keywords,
-            'imageUrl': self.image_url,
-            'additionalImages': additional_images,
-            'categoryName': self.category,
-            'category': self.category,
-            'offerType': self.offer_type,
-            'merchantName': self.business_name,
-            'businessName': self.business_name,
-            'merchantAddress': self.address,
-            'businessAddress': self.address,
-            'address': self.address,
-            'merchantPhone': self.phone,
-            'businessPhone': self.phone,
-            'phone': self.phone,
-            'merchantWebsite': self.offer_url,
-            'businessWebsite': self.offer_url,
-            'website': self.offer_url,
-            'offerUrl': self.offer_url,
-            'email': self.email,
-            'validFrom': self.starts_at.isoformat() if self.starts_at else None,
-            'validUntil': self.expires_at.isoformat() if self.expires_at else None,
-            'startsAt': self.starts_at.isoformat() if self.starts_at else None,
-            'expiresAt': self.expires_at.isoformat() if self.expires_at else None,
-            'isActive': self.status == 'approved',
-            'status': self.status,
-            'createdAt': self.created_at.isoformat() if self.created_at else None,
-            'approvedAt': self.approved_at.isoformat() if self.approved_at else None,
-            'city': self.city,
-            'businessId': self.business_id,
-            'isPremium': self.is_premium,
-            'isNationwide': self.is_nationwide,
-            'locationType': self.location_type,
-            'cost': float(self.cost) if self.cost else None,
-            'imageS3Key': self.image_s3_key
-        }
+        return _row_to_offer_dict({name: getattr(self, name) for name, _ in _OFFER_FIELDS}, additional_images)
 
     @staticmethod
     def create_table():
@@ -141,10 +189,58 @@ class Tarjous:
             raise error
 
     @staticmethod
-    def get_offers(page=1, limit=20, category=None, city=None):
-        """Get paginated offers from offers table with business information"""
+    def create_search_indexes():
+        """Create the indexes used by offer searches (trigram for ILIKE '%term%', approved offers by expiry and ranking)"""
+        indexes = [
+            ('offers_title_trgm', "CREATE INDEX CONCURRENTLY IF NOT EXISTS offers_title_trgm ON offers USING GIN (title gin_trgm_ops)"),
+            ('offers_description_trgm', "CREATE INDEX CONCURRENTLY IF NOT EXISTS offers_description_trgm ON offers USING GIN (description gin_trgm_ops)"),
+            ('offers_keywords_trgm', "CREATE INDEX CONCURRENTLY IF NOT EXISTS offers_keywords_trgm ON offers USING GIN (keywords gin_trgm_ops)"),
+            ('offers_category_trgm', "CREATE INDEX CONCURRENTLY IF NOT EXISTS offers_category_trgm ON offers USING GIN (category gin_trgm_ops)"),
+            ('businesses_business_name_trgm', "CREATE INDEX CONCURRENTLY IF NOT EXISTS businesses_business_name_trgm ON businesses USING GIN (business_name gin_trgm_ops)"),
+            ('offers_active_idx', "CREATE INDEX CONCURRENTLY IF NOT EXISTS offers_active_idx ON offers (expires_at) WHERE status = 'approved'"),
+            # Matches ORDER BY is_premium DESC, created_at DESC, id DESC LIMIT n so the scan can stop early,
+            # and lets a keyset cursor seek straight to the next page
+            ('offers_ranking_keyset_idx', "CREATE INDEX CONCURRENTLY IF NOT EXISTS offers_ranking_keyset_idx ON offers (is_premium DESC, created_at DESC, id DESC) WHERE status = 'approved'"),
+        ]
+        
         try:
-            offset = (page - 1) * limit
+            # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+            with get_db_connection(autocommit=True) as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+                    for name, statement in indexes:
+                        create_index_concurrently(cursor, name, statement)
+                    # Superseded by offers_ranking_keyset_idx
+                    cursor.execute("DROP INDEX CONCURRENTLY IF EXISTS offers_ranking_idx")
+            print('✅ Offer search indexes ready')
+        except Exception as error:
+            print(f'❌ Error creating offer search indexes: {error}')
+            raise error
+
+    @staticmethod
+    def encode_cursor(row):
+        """Opaque nextCursor for the listing position after row"""
+        key = f"{int(bool(row['is_premium']))}|{row['created_at'].isoformat()}|{row['id']}"
+        return base64.urlsafe_b64encode(key.encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """(is_premium, created_at, id) from a nextCursor; raises ValueError if malformed"""
+        try:
+            is_premium, created_at, offer_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+            return is_premium == '1', datetime.fromisoformat(created_at), offer_id
+        except Exception as error:
+            raise ValueError(f'Invalid cursor: {cursor}') from error
+
+    @staticmethod
+    def get_offers(page=1, limit=20, category=None, city=None, after=None):
+        """Get paginated offers from offers table with business information
+        
+        after is a decoded cursor (is_premium, created_at, id); when given, the page
+        starts right after that offer instead of skipping (page - 1) * limit rows.
+        """
+        try:
+            offset = 0 if after else (page - 1) * limit
             
             # Build WHERE clause for active offers - exclude hidden offers
             where_clause = "WHERE o.status = 'approved' AND (o.expires_at IS NULL OR o.expires_at > CURRENT_TIMESTAMP)"
@@ -159,17 +255,30 @@ class Tarjous:
                 where_clause += " AND (o.city::text ILIKE %s OR o.city::text ILIKE %s)"
                 params.extend([f'%{city}%', '%koko maa%'])
             
-            # Combined query using window function to get both data and count
-            combined_query = f"""
-            SELECT o.*, b.business_name, b.phone, b.email,
-                   COUNT(*) OVER() as total_count
+            count_params = list(params)
+            
+            # The SQL text depends on which filters are set, so each combination is its own prepared statement
+            filter_suffix = ('_category' if category else '') + ('_city' if city else '')
+            
+            # Keyset pagination: seek past the cursor on the ranking index instead of an OFFSET scan
+            page_where_clause = where_clause
+            if after:
+                page_where_clause += " AND (o.is_premium, o.created_at, o.id) < (%s, %s, %s)"
+                params.extend(after)
+            
+            # Page query without a window count, so the ranking index scan can stop at LIMIT
+            page_query = f"""
+            SELECT {_OFFER_COLUMNS}
             FROM offers o 
             LEFT JOIN businesses b ON o.business_id = b.id
-            {where_clause}
-            ORDER BY o.is_premium DESC, o.created_at DESC 
+            {page_where_clause}
+            ORDER BY o.is_premium DESC, o.created_at DESC, o.id DESC 
             LIMIT %s OFFSET %s
             """
-            params.extend([limit, offset])
+            combined_query = _WITH_ADDITIONAL_IMAGES.format(
+                page_query=page_query, order_by="p.is_premium DESC, p.created_at DESC, p.id DESC")
+            # One extra row tells whether a next page exists
+            params.extend([limit + 1, offset])
             
             # Debug logging
             print(f"🔍 SQL Query: {combined_query}")
@@ -178,28 +287,38 @@ class Tarjous:
             
             with get_db_connection() as conn:
                 with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
-                    cursor.execute(combined_query, params)
+                    execute_prepared(
+                        cursor, f"tarjous_offers_page{filter_suffix}{'_after' if after else ''}", combined_query, params
+                    )
                     results = cursor.fetchall()
+                    has_next = len(results) > limit
+                    results = results[:limit]
+                    
+                    count_key = (category, city)
+                    total_count = _offer_count_cache.get(count_key) if page > 1 or after else None
+                    if total_count is None:
+                        # Only offers columns are filtered on, so the count skips the businesses join
+                        execute_prepared(
+                            cursor, f'tarjous_offers_count{filter_suffix}',
+                            f"SELECT count(*) AS total_count FROM offers o {where_clause}", count_params
+                        )
+                        total_count = cursor.fetchone()['total_count']
+                        _offer_count_cache.set(count_key, total_count)
             
             print(f"🔍 Query results count: {len(results)}")
             if results:
                 print(f"🔍 First result keys: {list(results[0].keys())}")
             
-            # Extract total count from first row (all rows have same total_count due to window function)
-            total_count = results[0]['total_count'] if results and len(results) > 0 else 0
-            
-            # Convert to Tarjous objects, excluding the total_count field
-            offers = []
-            for row in results:
-                row_dict = dict(row)
-                # Remove total_count from the row data before creating Tarjous object
-                row_dict.pop('total_count', None)
-                offers.append(Tarjous(row_dict).to_dict())
+            # Rows already carry additional_images, so build the dicts without Tarjous objects
+            offers = [_row_to_offer_dict(row, row['additional_images']) for row in results]
             
             # Calculate pagination
             total_pages = (total_count + limit - 1) // limit if total_count > 0 else 0
-            has_next = page < total_pages
-            has_prev = page > 1
+            # A cursor page always has offers before it
+            has_prev = page > 1 or bool(after)
+            
+            # The client passes this back as ?after=
+            next_cursor = Tarjous.encode_cursor(results[-1]) if has_next else None
             
             return {
                 'offers': offers,
@@ -208,7 +327,8 @@ class Tarjous:
                     'totalPages': total_pages,
                     'totalCount': total_count,
                     'hasNext': has_next,
-                    'hasPrev': has_prev
+                    'hasPrev': has_prev,
+                    'nextCursor': next_cursor
                 }
             }
             
@@ -218,6 +338,18 @@ class Tarjous:
             print(f'❌ Full traceback: {traceback.format_exc()}')
             raise error
 
+    @staticmethod
+    def get_offers_json(page=1, limit=20, category=None, city=None, after=None):
+        """get_offers() serialized with orjson, cached briefly so hot feed pages skip the database and encoding"""
+        key = (page, limit, category, city, after)
+        cached = _offer_page_json_cache.get(key)
+        if cached is not None:
+            return cached
+        
+        body = orjson.dumps(Tarjous.get_offers(page, limit, category, city, after), option=orjson.OPT_SORT_KEYS)
+        _offer_page_json_cache.set(key, body)
+        return body
+
     @staticmethod
     def search_offers(search_term, page=1, limit=20):
         """Search offers by title, description, keywords, or business name with business information"""
@@ -225,46 +357,52 @@ class Tarjous:
             offset = (page - 1) * limit
             search_pattern = f"%{search_term}%"
             
-            # Combined search query using window function to get both data and count - exclude hidden offers
-            combined_search_query = """
-            SELECT o.*, b.business_name, b.phone, b.email,
-                   COUNT(*) OVER() as total_count
-            FROM offers o 
-            LEFT JOIN businesses b ON o.business_id = b.id 
+            # Search filter shared by the page and count queries - exclude hidden offers.
+            # Plain ILIKE per table lets the trigram indexes answer each side, instead of
+            # filtering LOWER(...) LIKE over the whole offers/businesses join
+            search_where_clause = """
             WHERE o.status = 'approved'
             AND (o.expires_at IS NULL OR o.expires_at > CURRENT_TIMESTAMP)
             AND (
-                LOWER(o.title) LIKE LOWER(%s) OR 
-                LOWER(o.description) LIKE LOWER(%s) OR 
-                LOWER(o.keywords) LIKE LOWER(%s) OR
-                LOWER(o.category) LIKE LOWER(%s) OR
-                LOWER(b.business_name) LIKE LOWER(%s)
+                o.id IN (
+                    SELECT id FROM offers 
+                    WHERE title ILIKE %s OR description ILIKE %s OR keywords ILIKE %s OR category ILIKE %s
+                )
+                OR o.business_id IN (SELECT id FROM businesses WHERE business_name ILIKE %s)
             )
+            """
+            
+            search_page_query = f"""
+            SELECT {_OFFER_COLUMNS},
+                   CASE WHEN o.title ILIKE %s THEN 1 ELSE 2 END as title_rank
+            FROM offers o 
+            LEFT JOIN businesses b ON o.business_id = b.id 
+            {search_where_clause}
             ORDER BY 
-                CASE WHEN LOWER(o.title) LIKE LOWER(%s) THEN 1 ELSE 2 END,
+                title_rank,
                 o.is_premium DESC,
                 o.created_at DESC
             LIMIT %s OFFSET %s
             """
+            combined_search_query = _WITH_ADDITIONAL_IMAGES.format(
+                page_query=search_page_query, order_by="p.title_rank, p.is_premium DESC, p.created_at DESC")
             
             with get_db_connection() as conn:
                 with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
-                    cursor.execute(combined_search_query, (
+                    execute_prepared(cursor, 'tarjous_search_page', combined_search_query, (
                         search_pattern, search_pattern, search_pattern, search_pattern, search_pattern,
                         search_pattern, limit, offset
                     ))
                     results = cursor.fetchall()
+                    
+                    # Search terms vary too much to cache; the live count skips the ORDER BY and businesses join
+                    execute_prepared(cursor, 'tarjous_search_count', f"SELECT count(*) AS total_count FROM offers o {search_where_clause}", (
+                        search_pattern, search_pattern, search_pattern, search_pattern, search_pattern
+                    ))
+                    total_count = cursor.fetchone()['total_count']
             
-            # Extract total count from first row (all rows have same total_count due to window function)
-            total_count = results[0]['total_count'] if results else 0
-            
-            # Convert to Tarjous objects, excluding the total_count field
-            offers = []
-            for row in results:
-                row_dict = dict(row)
-                # Remove total_count from the row data before creating Tarjous object
-                row_dict.pop('total_count', None)
-                offers.append(Tarjous(row_dict).to_dict())
+            # Rows already carry additional_images, so build the dicts without Tarjous objects
+            offers = [_row_to_offer_dict(row, row['additional_images']) for row in results]
             
             # Calculate pagination
             total_pages = (total_count + limit - 1) // limit
@@ -290,8 +428,8 @@ class Tarjous:
     def find_by_id(offer_id):
         """Find offer by ID with business information"""
         try:
-            query = """
-            SELECT o.*, b.business_name, b.phone, b.email
+            query = f"""
+            SELECT {_OFFER_COLUMNS}
             FROM offers o 
             LEFT JOIN businesses b ON o.business_id = b.id 
             WHERE o.id = %s AND o.status = 'approved'
@@ -300,7 +438,7 @@ class Tarjous:
             
             with get_db_connection() as conn:
                 with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
-                    cursor.execute(query, (offer_id,))
+                    execute_prepared(cursor, 'tarjous_find_by_id', query, (offer_id,))
                     result = cursor.fetchone()
             
             if not result:
@@ -312,6 +450,32 @@ class Tarjous:
             print(f'❌ Error finding offer by ID: {error}')
             raise error
 
+    @staticmethod
+    def is_live(offer_id):
+        """Whether offer_id is an approved, unexpired offer (cached for a minute)"""
+        live = _live_offer_cache.get(offer_id)
+        if live is not None:
+            return live
+        
+        try:
+            with get_db_connection(autocommit=True) as conn:
+                with conn.cursor() as cursor:
+                    execute_prepared(cursor, 'tarjous_is_live', """
+                        SELECT EXISTS (
+                            SELECT 1 FROM offers 
+                            WHERE id = %s AND status = 'approved'
+                            AND (expires_at IS NULL OR expires_at > CURRENT_TIMESTAMP)
+                        )
+                    """, (offer_id,))
+                    live = cursor.fetchone()[0]
+            
+            _live_offer_cache.set(offer_id, live)
+            return live
+            
+        except Exception as error:
+            print(f'❌ Error checking offer status: {error}')
+            raise error
+
     @staticmethod
     def create_offer(offer_data):
         """Create new offer"""
@@ -345,6 +509,9 @@ class Tarjous:
                     result = cursor.fetchone()
                     conn.commit()
             
+            _offer_page_json_cache.clear()
+            _offer_count_cache.clear()
+            
             return Tarjous(dict(result))
             
         except Exception as error:
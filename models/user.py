@@ -1,6 +1,7 @@
 import bcrypt
 from datetime import datetime
 from config.database import execute_query, execute_query_dict, get_db_connection
+from models.offer_analytics import OfferAnalytics
 import psycopg2.extras
 
 class User:
@@ -75,10 +76,15 @@ class User:
         city = user_data.get('city')
 
         try:
-            # Check if user already exists
-            existing_user = User.find_by_email(email)
-            if existing_user:
-                raise ValueError('User with this email already exists')
+            # Check if user already exists - EXISTS stops at the first match and builds no User
+            with get_db_connection(autocommit=True) as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(
+                        "SELECT EXISTS (SELECT 1 FROM users WHERE email = %s AND is_active = true)",
+                        (email,)
+                    )
+                    if cursor.fetchone()[0]:
+                        raise ValueError('User with this email already exists')
 
             # Hash password
             password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
@@ -440,7 +446,7 @@ class User:
                         
                         # Delete from offer_analytics table
                         try:
-                            cursor.execute("DELETE FROM offer_analytics WHERE user_id = %s", (user_id,))
+                            OfferAnalytics.delete_user_rows(cursor, user_id)
                             print(f"✅ Deleted offer_analytics for user {user_id}")
                         except Exception as e:
                             print(f"⚠️ Could not delete from offer_analytics: {e}")
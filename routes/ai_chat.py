@@ -1,9 +1,9 @@
 from flask import Blueprint, request, jsonify
-from flask_jwt_extended import jwt_required, get_jwt_identity
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from models.ai_chat import AIChat
 from models.user import User
+from middleware.auth import require_auth
 from datetime import datetime
 
 # Create blueprint
@@ -18,14 +18,14 @@ def init_limiter(app_limiter):
     limiter = app_limiter
 
 @ai_chat_bp.route('/ai-chat', methods=['POST'])
-@jwt_required()
+@require_auth
 def ai_chat():
     """AI chat endpoint"""
     if limiter:
         limiter.limit("30 per minute")(ai_chat)
     
     try:
-        user_id = get_jwt_identity()
+        user_id = request.user_id
         data = request.get_json()
         
         print(f"📋 JSON Data: {data}")
@@ -50,8 +50,8 @@ def ai_chat():
                 'message': f'Message too long. Maximum 150 characters allowed. Your message has {len(user_message)} characters.'
             }), 400
         
-        # Create AIChat instance to get dynamic chat limit
-        ai_chat_instance = AIChat()
+        # Shared AIChat instance provides the dynamic chat limit
+        ai_chat_instance = AIChat.instance()
         dynamic_chat_limit = ai_chat_instance.get_chat_limit()
         
         # Check if user has exceeded daily limit using dynamic limit
@@ -103,14 +103,14 @@ def ai_chat():
         }), 500
 
 @ai_chat_bp.route('/chat/usage', methods=['GET'])
-@jwt_required()
+@require_auth
 def get_ai_chat_usage():
     """Get AI chat usage statistics"""
     try:
-        user_id = get_jwt_identity()
+        user_id = request.user_id
         
-        # Get dynamic chat limit from AIChat instance
-        ai_chat_instance = AIChat()
+        # Get dynamic chat limit from the shared AIChat instance
+        ai_chat_instance = AIChat.instance()
         dynamic_chat_limit = ai_chat_instance.get_chat_limit()
         
         # Get usage statistics from User model
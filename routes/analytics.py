@@ -1,10 +1,10 @@
 from flask import Blueprint, request, jsonify
-from flask_jwt_extended import jwt_required, get_jwt_identity
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from models.analytics import Analytics
 from models.simple_analytics import SimpleAnalytics
 from models.offer_analytics import OfferAnalytics
+from middleware.auth import require_auth
 from datetime import datetime, timedelta
 
 # Create blueprint
@@ -19,11 +19,11 @@ def init_limiter(app_limiter):
     limiter = app_limiter
 
 @analytics_bp.route('/analytics/track', methods=['POST'])
-@jwt_required()
+@require_auth
 def track_analytics():
     """Track analytics event"""
     try:
-        user_id = get_jwt_identity()
+        user_id = request.user_id
         data = request.get_json()
         
         if not data:
@@ -76,7 +76,7 @@ def track_analytics():
         }), 500
 
 @analytics_bp.route('/analytics/dashboard', methods=['GET'])
-@jwt_required()
+@require_auth
 def get_dashboard_data():
     """Get dashboard analytics data"""
     try:
@@ -101,7 +101,7 @@ def get_dashboard_data():
         }), 500
 
 @analytics_bp.route('/analytics/location', methods=['GET'])
-@jwt_required()
+@require_auth
 def get_location_analytics():
     """Get location-based analytics"""
     try:
@@ -126,7 +126,7 @@ def get_location_analytics():
         }), 500
 
 @analytics_bp.route('/analytics/offers/<int:offer_id>/location', methods=['GET'])
-@jwt_required()
+@require_auth
 def get_offer_location_analytics(offer_id):
     """Get location analytics for specific offer"""
     try:
@@ -151,7 +151,7 @@ def get_offer_location_analytics(offer_id):
         }), 500
 
 @analytics_bp.route('/analytics/cities', methods=['GET'])
-@jwt_required()
+@require_auth
 def get_city_analytics():
     """Get city-based analytics"""
     try:
@@ -1,8 +1,10 @@
 from flask import Blueprint, request, jsonify
-from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity
+from flask_jwt_extended import create_access_token
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from models.user import User
+from models.offer_analytics import invalidate_user_city
+from middleware.auth import require_auth
 import bcrypt
 
 # Create blueprint
@@ -125,11 +127,11 @@ def login():
         }), 500
 
 @auth_bp.route('/auth/profile', methods=['GET'])
-@jwt_required()
+@require_auth
 def get_profile():
     """Get user profile"""
     try:
-        user_id = get_jwt_identity()
+        user_id = request.user_id
         user = User.find_by_id(user_id)
         
         if not user:
@@ -153,11 +155,11 @@ def get_profile():
         }), 500
 
 @auth_bp.route('/auth/profile', methods=['PUT'])
-@jwt_required()
+@require_auth
 def update_profile():
     """Update user profile"""
     try:
-        user_id = get_jwt_identity()
+        user_id = request.user_id
         data = request.get_json()
         
         if not data:
@@ -177,6 +179,7 @@ def update_profile():
         
         # Update user profile using instance method
         updated_user = user.update_profile(data)
+        invalidate_user_city(user_id)
         
         return jsonify({
             'success': True,
@@ -194,14 +197,14 @@ def update_profile():
         }), 500
 
 @auth_bp.route('/auth/change-password', methods=['POST'])
-@jwt_required()
+@require_auth
 def change_password():
     """Change user password"""
     if limiter:
         limiter.limit("5 per hour")(change_password)
     
     try:
-        user_id = get_jwt_identity()
+        user_id = request.user_id
         data = request.get_json()
         
         if not data or not data.get('currentPassword') or not data.get('newPassword'):
@@ -263,7 +266,7 @@ def change_password():
         }), 500
 
 @auth_bp.route('/auth/logout', methods=['POST'])
-@jwt_required()
+@require_auth
 def logout():
     """User logout endpoint"""
     try:
@@ -283,11 +286,11 @@ def logout():
         })
 
 @auth_bp.route('/auth/update-city', methods=['PUT'])
-@jwt_required()
+@require_auth
 def update_city():
     """Update user city"""
     try:
-        user_id = get_jwt_identity()
+        user_id = request.user_id
         data = request.get_json()
         
         if not data or not data.get('city'):
@@ -307,6 +310,7 @@ def update_city():
         
         # Update user city using instance method
         success = user.update_city(data['city'])
+        invalidate_user_city(user_id)
         
         if success:
             return jsonify({
@@ -330,14 +334,14 @@ def update_city():
         }), 500
 
 @auth_bp.route('/auth/delete-account', methods=['DELETE'])
-@jwt_required()
+@require_auth
 def delete_account():
     """Delete user account"""
     if limiter:
         limiter.limit("3 per hour")(delete_account)
     
     try:
-        user_id = get_jwt_identity()
+        user_id = request.user_id
         data = request.get_json()
         
         if not data or not data.get('password'):
@@ -356,6 +360,7 @@ def delete_account():
         
         # Delete user account
         success = User.delete_user(user_id)
+        invalidate_user_city(user_id)
         
         if success:
             return jsonify({
@@ -1,10 +1,10 @@
-from flask import Blueprint, request, jsonify
-from flask_jwt_extended import jwt_required, get_jwt_identity
+from flask import Blueprint, Response, request, jsonify
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from models.tarjous import Tarjous
 from models.category import Category
 from models.offer_analytics import OfferAnalytics
+from middleware.auth import require_auth
 from datetime import datetime
 
 # Create blueprint
@@ -19,20 +19,19 @@ def init_limiter(app_limiter):
     limiter = app_limiter
 
 @offers_bp.route('/categories', methods=['GET'])
-@jwt_required()
+@require_auth
 def get_categories():
     """Get all categories"""
     if limiter:
         limiter.limit("250 per hour")(get_categories)
     
     try:
-        categories = Category.get_all_categories()
-        return jsonify({
-            'success': True,
-            'data': {
-                'categories': categories
-            }
-        })
+        # Same body jsonify would build (sorted keys), around the cached category JSON
+        categories = Category.get_all_categories_json()
+        return Response(
+            b'{"data":{"categories":' + categories + b'},"success":true}',
+            mimetype='application/json'
+        )
     except Exception as e:
         print(f"Categories error: {e}")
         return jsonify({
@@ -59,13 +58,20 @@ def get_public_offers():
         if limit < 1 or limit > 50:
             limit = 20
         
-        # Get offers
-        result = Tarjous.get_offers(page=page, limit=limit, category=category, city=city)
-        
-        return jsonify({
-            'success': True,
-            'data': result
-        })
+        # Keyset cursor from a previous page's nextCursor
+        after = request.args.get('after')
+        if after:
+            try:
+                after = Tarjous.decode_cursor(after)
+            except ValueError:
+                return jsonify({
+                    'success': False,
+                    'message': 'Invalid cursor'
+                }), 400
+        
+        # Same body jsonify would build (sorted keys), around the cached page JSON
+        result = Tarjous.get_offers_json(page=page, limit=limit, category=category, city=city, after=after)
+        return Response(b'{"data":' + result + b',"success":true}', mimetype='application/json')
         
     except Exception as e:
         print(f"Get public offers error: {e}")
@@ -75,7 +81,7 @@ def get_public_offers():
         }), 500
 
 @offers_bp.route('/tarjoukset', methods=['GET'])
-@jwt_required()
+@require_auth
 def get_offers():
     """Get paginated offers"""
     if limiter:
@@ -94,13 +100,20 @@ def get_offers():
         if limit < 1 or limit > 50:
             limit = 20
         
-        # Get offers
-        result = Tarjous.get_offers(page=page, limit=limit, category=category, city=city)
-        
-        return jsonify({
-            'success': True,
-            'data': result
-        })
+        # Keyset cursor from a previous page's nextCursor
+        after = request.args.get('after')
+        if after:
+            try:
+                after = Tarjous.decode_cursor(after)
+            except ValueError:
+                return jsonify({
+                    'success': False,
+                    'message': 'Invalid cursor'
+                }), 400
+        
+        # Same body jsonify would build (sorted keys), around the cached page JSON
+        result = Tarjous.get_offers_json(page=page, limit=limit, category=category, city=city, after=after)
+        return Response(b'{"data":' + result + b',"success":true}', mimetype='application/json')
         
     except Exception as e:
         print(f"Get offers error: {e}")
@@ -110,7 +123,7 @@ def get_offers():
         }), 500
 
 @offers_bp.route('/tarjoukset/search', methods=['GET'])
-@jwt_required()
+@require_auth
 def search_offers():
     """Search offers"""
     try:
@@ -148,7 +161,7 @@ def search_offers():
         }), 500
 
 @offers_bp.route('/tarjoukset/<offer_id>', methods=['GET'])
-@jwt_required()
+@require_auth
 def get_offer_details(offer_id):
     """Get offer details by ID"""
     try:
@@ -176,15 +189,14 @@ def get_offer_details(offer_id):
         }), 500
 
 @offers_bp.route('/tarjoukset/<offer_id>/click', methods=['POST'])
-@jwt_required()
+@require_auth
 def track_offer_click(offer_id):
     """Track offer click"""
     try:
-        user_id = get_jwt_identity()
+        user_id = request.user_id
         
         # Verify offer exists
-        offer = Tarjous.find_by_id(offer_id)
-        if not offer:
+        if not Tarjous.is_live(offer_id):
             return jsonify({
                 'success': False,
                 'message': 'Offer not found'
@@ -210,15 +222,14 @@ def track_offer_click(offer_id):
         }), 500
 
 @offers_bp.route('/tarjoukset/<offer_id>/conversion/website', methods=['POST'])
-@jwt_required()
+@require_auth
 def track_website_conversion(offer_id):
     """Track website visit conversion"""
     try:
-        user_id = get_jwt_identity()
+        user_id = request.user_id
         
         # Verify offer exists
-        offer = Tarjous.find_by_id(offer_id)
-        if not offer:
+        if not Tarjous.is_live(offer_id):
             return jsonify({
                 'success': False,
                 'message': 'Offer not found'
@@ -244,15 +255,14 @@ def track_website_conversion(offer_id):
         }), 500
 
 @offers_bp.route('/tarjoukset/<offer_id>/conversion/call', methods=['POST'])
-@jwt_required()
+@require_auth
 def track_call_conversion(offer_id):
     """Track phone call conversion"""
     try:
-        user_id = get_jwt_identity()
+        user_id = request.user_id
         
         # Verify offer exists
-        offer = Tarjous.find_by_id(offer_id)
-        if not offer:
+        if not Tarjous.is_live(offer_id):
             return jsonify({
                 'success': False,
                 'message': 'Offer not found'
@@ -278,15 +288,14 @@ def track_call_conversion(offer_id):
         }), 500
 
 @offers_bp.route('/tarjoukset/<offer_id>/conversion/directions', methods=['POST'])
-@jwt_required()
+@require_auth
 def track_directions_conversion(offer_id):
     """Track directions request conversion"""
     try:
-        user_id = get_jwt_identity()
+        user_id = request.user_id
         
         # Verify offer exists
-        offer = Tarjous.find_by_id(offer_id)
-        if not offer:
+        if not Tarjous.is_live(offer_id):
             return jsonify({
                 'success': False,
                 'message': 'Offer not found'